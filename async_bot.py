@@ -0,0 +1,460 @@
+'''
+Asyncio front end of the bot. It talks to the Telegram Bot API directly
+with aiohttp, handles every update in its own task and runs graph
+building and rendering in a process pool
+'''
+import asyncio
+import logging
+import math
+import multiprocessing
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import aiohttp
+
+import constants as c
+import dataset
+import metrics
+import render
+import workers
+
+
+class TelegramClient:
+    '''
+    Minimal asynchronous client of the Telegram Bot API
+    '''
+
+    def __init__(self, session, token, api_url=c.TELEGRAM_API):
+        self.session = session
+        self.url = '{}/bot{}/'.format(api_url.rstrip('/'), token)
+
+    async def call(self, method, data=None, **params):
+        '''
+        Calls the API method and returns its result
+        '''
+        params = {key: value for key, value in params.items() if value is not None}
+        json = params if data is None else None
+        async with self.session.post(self.url + method, data=data, json=json) as res:
+            body = await res.json()
+        if not body.get('ok'):
+            raise RuntimeError('{} failed: {}'.format(method, body.get('description')))
+        return body['result']
+
+    async def get_updates(self, offset, timeout):
+        '''
+        Long-polls the updates after offset
+        '''
+        return await self.call('getUpdates', offset=offset, timeout=timeout)
+
+    async def send_message(self, chat_id, text, parse_mode=None):
+        '''
+        Sends the text message to chat_id
+        '''
+        params = {'chat_id': chat_id, 'text': text}
+        if parse_mode:
+            params['parse_mode'] = parse_mode
+        return await self.call('sendMessage', **params)
+
+    async def send_photo(self, chat_id, photo):
+        '''
+        Sends the PNG bytes photo to chat_id
+        '''
+        data = aiohttp.FormData()
+        data.add_field('chat_id', str(chat_id))
+        data.add_field('photo', photo, filename='map.png', content_type='image/png')
+        return await self.call('sendPhoto', data=data)
+
+
+def parse_plot_args(args, usercoords):
+    '''
+    Returns ((dist, lat, lon), None) with the arguments of plotpop and
+    plotgraph, or (None, error text)
+    '''
+    if len(args) == 1:
+        if not args[0].isdigit():
+            return None, c.WRONG_ARGS
+        if not usercoords:
+            return None, c.NOT_SPECIFIED_CHOORDS
+        return (int(args[0]), usercoords[0], usercoords[1]), None
+
+    if len(args) != 3:
+        return None, c.WRONG_ARGS
+
+    try:
+        dist, lat, lon = int(args[0]), float(args[1]), float(args[2])
+    except ValueError:
+        return None, c.WRONG_ARGS
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return None, c.INVALID_COORDS
+    return (dist, lat, lon), None
+
+
+def parse_route_args(args):
+    '''
+    Returns the two quoted city names of the arguments of route, or None
+    '''
+    cities = ' '.join(args).split('"')
+    if len(cities) != 5:
+        return
+    return cities[1], cities[3]
+
+
+def parse_distances_args(args):
+    '''
+    Returns the quoted source and target names of the arguments of
+    distances, or None
+    '''
+    cities = ' '.join(args).split('"')
+    if len(cities) % 2 == 0 or len(cities) < 5:
+        return
+    return cities[1], cities[3::2]
+
+
+def distances_text(dsts, lengths):
+    '''
+    Returns a line with the length of the route to each of dsts
+    '''
+    lines = []
+    for dst, length in zip(dsts, lengths):
+        if length == c.DEST_FAIL:
+            lines.append(c.NO_DISTANCE_CITY.format(city=dst))
+        elif length == c.PATH_FAIL:
+            lines.append(c.NO_DISTANCE_ROUTE.format(city=dst))
+        else:
+            lines.append(c.DISTANCE_TEXT.format(city=dst, dist=length))
+    return '\n'.join(lines)
+
+
+def bbox(lat, lon, dist):
+    '''
+    Returns the bounding box (lat_min, lon_min, lat_max, lon_max) of the
+    circle of radius dist around (lat, lon)
+    '''
+    dlat = math.degrees(dist/c.EARTH_RADIUS)
+    dlon = dlat/max(math.cos(math.radians(lat)), 0.01)
+    return (
+        max(lat - dlat, -85), max(lon - dlon, -180),
+        min(lat + dlat, 85), min(lon + dlon, 180)
+    )
+
+
+class AsyncBot:
+    '''
+    Serves the bot commands concurrently on an asyncio event loop
+    '''
+
+    def __init__(self, client, session, executor):
+        self.client = client
+        self.session = session
+        self.executor = executor
+        self.chats = defaultdict(dict)
+        self.queued = 0
+        self.running = asyncio.Semaphore(c.RENDER_WORKERS)
+        # Queued or running jobs of each chat, only of the chats with some
+        self.per_chat = dict()
+        self.handlers = {
+            'start': self.start,
+            'help': self.bot_help,
+            'author': self.author,
+            'graph': self.change_graph,
+            'nodes': self.nodes,
+            'edges': self.edges,
+            'components': self.components,
+            'plotpop': self.plotpop,
+            'plotgraph': self.plotgraph,
+            'route': self.route,
+            'distances': self.distances,
+            'stats': self.stats,
+        }
+
+    async def run_job(self, chat_id, func, *args):
+        '''
+        Runs func(*args) in the process pool, with the same bounds as the
+        worker pool of the threaded bot. Returns (result, None) or
+        (None, error text)
+        '''
+        if self.queued >= c.MAX_QUEUED_JOBS or \
+                self.per_chat.get(chat_id, 0) >= c.MAX_QUEUED_JOBS_PER_CHAT:
+            return None, c.BUSY_TEXT
+
+        self.queued += 1
+        self.per_chat[chat_id] = self.per_chat.get(chat_id, 0) + 1
+        try:
+            queued_at = time.perf_counter()
+            async with self.running:
+                metrics.observe('queue.wait', time.perf_counter() - queued_at)
+                loop = asyncio.get_running_loop()
+                result, timings = await loop.run_in_executor(
+                    self.executor, workers.measured, func, *args
+                )
+            metrics.merge(timings)
+            return result, None
+        except Exception:
+            logging.exception('Job %s failed', func.__name__)
+            return None, c.JOB_FAILED
+        finally:
+            self.queued -= 1
+            self.per_chat[chat_id] -= 1
+            if not self.per_chat[chat_id]:
+                del self.per_chat[chat_id]
+
+    async def handle(self, update):
+        '''
+        Handles one update from Telegram
+        '''
+        message = update.get('message')
+        if not message:
+            return
+        chat_id = message['chat']['id']
+        state = self.chats[chat_id]
+
+        if 'location' in message:
+            if 'graph' not in state:
+                await self.client.send_message(chat_id, c.NOT_STARTED)
+                return
+            location = message['location']
+            state['usercoords'] = (location['latitude'], location['longitude'])
+            await self.client.send_message(chat_id, c.OK_TEXT)
+            return
+
+        words = message.get('text', '').split()
+        if not words or not words[0].startswith('/'):
+            return
+        command = words[0][1:].split('@')[0]
+        handler = self.handlers.get(command)
+        if handler is None:
+            return
+        if command not in ('start', 'stats') and 'graph' not in state:
+            await self.client.send_message(chat_id, c.NOT_STARTED)
+            return
+
+        try:
+            with metrics.timer('command.' + command):
+                await handler(chat_id, state, words[1:])
+        except Exception:
+            logging.exception('Command %s failed', command)
+            await self.client.send_message(chat_id, c.JOB_FAILED)
+
+    async def start(self, chat_id, state, args):
+        '''
+        Builds the default graph in the pool and writes a Hello message
+        '''
+        key = (c.MAX_DISTANCE, c.MIN_POPULATION)
+        _, error = await self.run_job(chat_id, workers.build_job, *key)
+        if error:
+            await self.client.send_message(chat_id, error)
+            return
+        state['graph'] = key
+        state['usercoords'] = None
+        await self.client.send_message(chat_id, c.HELLO_TEXT)
+
+    async def bot_help(self, chat_id, state, args):
+        '''
+        Writes help about the bot
+        '''
+        await self.client.send_message(chat_id, c.HELP_TEXT, parse_mode='Markdown')
+
+    async def author(self, chat_id, state, args):
+        '''
+        Writes info about the author
+        '''
+        await self.client.send_message(chat_id, c.AUTHOR_INFO, parse_mode='Markdown')
+
+    async def change_graph(self, chat_id, state, args):
+        '''
+        Builds the graph with args[0] as max_dist and args[1] as min_pop
+        in the pool and starts using it
+        '''
+        try:
+            if len(args) != 2:
+                raise ValueError
+            distance, population = float(args[0]), float(args[1])
+            max_dist, min_pop = int(args[0]), int(args[1])
+        except ValueError:
+            await self.client.send_message(chat_id, c.WRONG_ARGS)
+            return
+
+        if distance > c.MAX_USER_DISTANCE:
+            await self.client.send_message(chat_id, c.TOO_LARGE_DISTANCE)
+            return
+        if population < c.MIN_USER_POPULATION:
+            await self.client.send_message(chat_id, c.TOO_LOW_POPULATION)
+            return
+
+        _, error = await self.run_job(chat_id, workers.build_job, max_dist, min_pop)
+        if error:
+            await self.client.send_message(chat_id, error)
+            return
+        state['graph'] = (max_dist, min_pop)
+        await self.client.send_message(chat_id, c.OK_TEXT)
+
+    async def count(self, command, chat_id, state):
+        '''
+        Writes the result of the count command ('get_number_nodes',
+        'get_number_edges' or 'get_number_components') of the current graph
+        '''
+        result, error = await self.run_job(chat_id, workers.count_job, state['graph'], command)
+        await self.client.send_message(chat_id, error or str(result))
+
+    async def nodes(self, chat_id, state, args):
+        '''
+        Writes the number of nodes of the current graph
+        '''
+        await self.count('get_number_nodes', chat_id, state)
+
+    async def edges(self, chat_id, state, args):
+        '''
+        Writes the number of edges of the current graph
+        '''
+        await self.count('get_number_edges', chat_id, state)
+
+    async def components(self, chat_id, state, args):
+        '''
+        Writes the number of connected components of the graph
+        '''
+        await self.count('get_number_components', chat_id, state)
+
+    async def plot(self, command, chat_id, state, args):
+        '''
+        Runs the plot command ('plotpop' or 'plotgraph') and sends its image
+        '''
+        parsed, error = parse_plot_args(args, state.get('usercoords'))
+        if error:
+            await self.client.send_message(chat_id, error)
+            return
+        dist, lat, lon = parsed
+
+        # Fetch the base map tiles here, so the renderer finds them cached
+        box = bbox(lat, lon, dist)
+        zoom = render.zoom_for_bbox(*box)
+        await render.fetch_tiles_async(self.session, *box, [zoom, min(zoom + 1, 17)])
+
+        image, error = await self.run_job(
+            chat_id, workers.plot_job, state['graph'], command, lat, lon, dist
+        )
+        if error:
+            await self.client.send_message(chat_id, error)
+        elif image is None:
+            await self.client.send_message(chat_id, c.NO_IMAGE)
+        else:
+            await self.client.send_photo(chat_id, image)
+
+    async def plotpop(self, chat_id, state, args):
+        '''
+        Plots the cities around a point, sized by population
+        '''
+        await self.plot('plotpop', chat_id, state, args)
+
+    async def plotgraph(self, chat_id, state, args):
+        '''
+        Plots the edges between the cities around a point
+        '''
+        await self.plot('plotgraph', chat_id, state, args)
+
+    async def route(self, chat_id, state, args):
+        '''
+        Plots the shortest route between two quoted cities
+        '''
+        parsed = parse_route_args(args)
+        if not parsed:
+            await self.client.send_message(chat_id, c.WRONG_ARGS)
+            return
+
+        image, error = await self.run_job(
+            chat_id, workers.route_job, state['graph'], parsed[0], parsed[1]
+        )
+        if error:
+            await self.client.send_message(chat_id, error)
+        elif image == c.SOURCE_FAIL:
+            await self.client.send_message(chat_id, c.NO_CITY.format(city=parsed[0]))
+        elif image == c.DEST_FAIL:
+            await self.client.send_message(chat_id, c.NO_CITY.format(city=parsed[1]))
+        elif image == c.PATH_FAIL:
+            await self.client.send_message(chat_id, c.NO_ROUTE)
+        else:
+            await self.client.send_photo(chat_id, image)
+
+    async def distances(self, chat_id, state, args):
+        '''
+        Writes the length of the shortest route from the first quoted city
+        to each of the others
+        '''
+        parsed = parse_distances_args(args)
+        if not parsed:
+            await self.client.send_message(chat_id, c.WRONG_ARGS)
+            return
+
+        src, dsts = parsed
+        lengths, error = await self.run_job(
+            chat_id, workers.distances_job, state['graph'], src, dsts
+        )
+        if error:
+            await self.client.send_message(chat_id, error)
+        elif lengths and lengths[0] == c.SOURCE_FAIL:
+            await self.client.send_message(chat_id, c.NO_CITY.format(city=src))
+        else:
+            await self.client.send_message(chat_id, distances_text(dsts, lengths))
+
+    async def stats(self, chat_id, state, args):
+        '''
+        Writes the latency percentiles of the commands and stages, only to
+        the admins
+        '''
+        if metrics.is_admin(chat_id):
+            await self.client.send_message(
+                chat_id, '```\n' + metrics.report() + '\n```', 'Markdown'
+            )
+
+    async def poll(self):
+        '''
+        Long-polls Telegram forever, handling each update in its own task
+        '''
+        offset = None
+        tasks = set()
+        while True:
+            try:
+                updates = await self.client.get_updates(offset, c.POLL_TIMEOUT)
+            except (aiohttp.ClientError, asyncio.TimeoutError, RuntimeError):
+                logging.exception('getUpdates failed')
+                await asyncio.sleep(1)
+                continue
+
+            for update in updates:
+                offset = update['update_id'] + 1
+                task = asyncio.ensure_future(self.handle(update))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+
+async def serve(token, api_url=c.TELEGRAM_API):
+    '''
+    Runs the bot against the Bot API at api_url
+    '''
+    executor = ProcessPoolExecutor(
+        c.RENDER_WORKERS, mp_context=multiprocessing.get_context('spawn')
+    )
+    timeout = aiohttp.ClientTimeout(total=c.POLL_TIMEOUT + 30)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        await dataset.load_cities_async(session)
+        client = TelegramClient(session, token, api_url)
+        try:
+            await AsyncBot(client, session, executor).poll()
+        finally:
+            executor.shutdown()
+
+
+def main():
+    '''
+    Main function
+    '''
+    logging.basicConfig(level=logging.INFO)
+    token = open('token.txt').read().strip()
+    api_url = os.environ.get(c.TELEGRAM_API_ENV) or c.TELEGRAM_API
+    metrics.serve_from_env()
+    asyncio.run(serve(token, api_url))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,261 @@
+'''
+Benchmark of graph building, queries and rendering on synthetic cities
+or on a local copy of the dataset, without Telegram nor network
+'''
+import argparse
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import constants as c
+
+
+def synthetic_cities(n, clusters, spread, clustered=0.8, seed=0):
+    '''
+    Returns a DataFrame like the dataset with n cities. A fraction
+    clustered of them are spread normally (with deviation spread km)
+    around clusters centers, the rest uniformly on the sphere. Populations
+    follow a lognormal distribution, as in the real data
+    '''
+    import pandas as pd
+
+    rng = np.random.RandomState(seed)
+
+    def uniform_points(count):
+        lats = np.degrees(np.arcsin(rng.uniform(-0.95, 0.95, count)))
+        return lats, rng.uniform(-180, 180, count)
+
+    n_clustered = int(n*clustered) if clusters else 0
+    center_lats, center_lons = uniform_points(max(clusters, 1))
+    cluster = rng.randint(0, max(clusters, 1), n)
+    cluster[n_clustered:] = -1
+
+    lats, lons = uniform_points(n)
+    around = cluster >= 0
+    dlat = rng.normal(0, spread, n)/c.EARTH_RADIUS
+    dlon = rng.normal(0, spread, n)/c.EARTH_RADIUS
+    lats[around] = center_lats[cluster[around]] + np.degrees(dlat[around])
+    lons[around] = center_lons[cluster[around]] + np.degrees(
+        dlon[around]/np.maximum(np.cos(np.radians(center_lats[cluster[around]])), 0.1)
+    )
+    lats = np.clip(lats, -89, 89)
+    lons = (lons + 180) % 360 - 180
+
+    ids = np.arange(n)
+    dataframe = pd.DataFrame({
+        'Country': ['c{}'.format(k) for k in np.maximum(cluster, 0) % 200],
+        'AccentCity': ['City{}'.format(i) for i in ids],
+        'Region': ['{:02d}'.format(i % 30) for i in ids],
+        'Population': np.round(rng.lognormal(np.log(5000), 1.5, n)),
+        'Latitude': lats.astype(np.float32),
+        'Longitude': lons.astype(np.float32)
+    })
+    for column in ('Country', 'Region'):
+        dataframe[column] = dataframe[column].astype('category')
+    return dataframe
+
+
+def summary(seconds):
+    '''
+    Returns the count, p50, p99 and max of the list of timings
+    '''
+    if not seconds:
+        return {'count': 0}
+    return {
+        'count': len(seconds),
+        'p50': float(np.percentile(seconds, 50)),
+        'p99': float(np.percentile(seconds, 99)),
+        'max': float(max(seconds))
+    }
+
+
+def timed(func, *args):
+    '''
+    Returns the result of func(*args) and the seconds it took
+    '''
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def misspell(name, rng):
+    '''
+    Returns the "city, country" part of name with one character dropped,
+    like a user query with a typo
+    '''
+    label = name.split(';')[0]
+    if len(label) < 4:
+        return label
+    drop = rng.randint(1, len(label) - 1)
+    return label[:drop] + label[drop + 1:]
+
+
+def bench_graph(cities, max_dist, min_pop, args, rng):
+    '''
+    Returns the timings of every stage for the graph (max_dist, min_pop)
+    '''
+    import graph
+    import graph_utilities as gu
+
+    stages = dict()
+
+    g, seconds = timed(graph.Graph, max_dist, min_pop, cities, args.workers)
+    stages['build'] = {'seconds': seconds}
+    if args.memory:
+        tracemalloc.start()
+        graph.Graph(max_dist, min_pop, cities, args.workers)
+        stages['build']['peak_mb'] = tracemalloc.get_traced_memory()[1]/1e6
+        tracemalloc.stop()
+
+    result = {
+        'max_dist': max_dist,
+        'min_pop': min_pop,
+        'nodes': g.get_number_nodes(),
+        'edges': g.get_number_edges(),
+        'components': g.get_number_components(),
+        'stages': stages
+    }
+    n = g.get_number_nodes()
+    if n == 0:
+        return result
+
+    # The geometric search alone, the bulk of the build for large distances
+    _, seconds = timed(gu.build_edges, g.lats, g.lons, max_dist, args.workers)
+    stages['build_edges'] = {'seconds': seconds}
+
+    snapshot = tempfile.mkdtemp(prefix='graphbot-bench-')
+    try:
+        _, seconds = timed(g.save, os.path.join(snapshot, 'graph'))
+        stages['save'] = {'seconds': seconds}
+        _, seconds = timed(graph.Graph.load, os.path.join(snapshot, 'graph'))
+        stages['load'] = {'seconds': seconds}
+    finally:
+        shutil.rmtree(snapshot)
+
+    if args.derive:
+        _, seconds = timed(g.derive, max_dist, min_pop*2)
+        stages['derive'] = {'seconds': seconds}
+
+    # Indexes built on first use, timed apart from the queries
+    _, seconds = timed(lambda: g.kdtree)
+    stages['kdtree'] = {'seconds': seconds}
+    _, seconds = timed(lambda: g.city_index)
+    stages['name_index'] = {'seconds': seconds}
+    _, seconds = timed(lambda: g.landmarks)
+    stages['landmarks'] = {'seconds': seconds}
+
+    nodes = rng.randint(0, n, args.queries)
+
+    # Routes join two cities of the same component
+    components = np.asarray(g.components)
+    sizes = np.bincount(components)
+    connected = np.flatnonzero(sizes[components] > 1)
+    pairs = []
+    for src in rng.choice(connected, min(args.queries, len(connected))).tolist():
+        others = np.flatnonzero(components == components[src])
+        pairs.append((src, int(rng.choice(others[others != src]))))
+    timings = {
+        'get_most_similar': [], 'cities_within': [], 'plotgraph': [],
+        'plotpop': [], 'shortest_path': [], 'route': [], 'distances': []
+    }
+    for node in nodes.tolist():
+        query = misspell(g.names[node], rng)
+        timings['get_most_similar'].append(timed(g.get_most_similar, query)[1])
+
+        # The private renderers skip the image cache
+        lat, lon = float(g.lats[node]), float(g.lons[node])
+        timings['cities_within'].append(timed(g.cities_within, lat, lon, args.plot_dist)[1])
+        timings['plotgraph'].append(timed(g._plotgraph, lat, lon, args.plot_dist)[1])
+        timings['plotpop'].append(timed(g._plotpop, lat, lon, args.plot_dist)[1])
+
+    for src, dst in pairs:
+        timings['shortest_path'].append(timed(g.shortest_path, src, dst)[1])
+        timings['route'].append(timed(g.route, g.names[src], g.names[dst])[1])
+
+    # One source to all the queried cities, in a single search
+    targets = [g.names[node] for node in nodes.tolist()]
+    for src, _ in pairs:
+        timings['distances'].append(timed(g.distances, g.names[src], targets)[1])
+
+    for stage, seconds in timings.items():
+        stages[stage] = summary(seconds)
+    return result
+
+
+def main():
+    '''
+    Command line tool: runs the benchmark and prints its results as JSON
+    '''
+    parser = argparse.ArgumentParser(description='GraphBot benchmark')
+    parser.add_argument('--dataset', help='local copy of worldcitiespop.csv.gz, '
+                                          'instead of synthetic cities')
+    parser.add_argument('--cities', type=int, default=50000, help='synthetic cities')
+    parser.add_argument('--clusters', type=int, default=100)
+    parser.add_argument('--spread', type=float, default=200, help='km around each cluster')
+    parser.add_argument('--clustered', type=float, default=0.8,
+                        help='fraction of the cities in clusters')
+    parser.add_argument('--dist', type=int, nargs='+', default=[100, 300])
+    parser.add_argument('--pop', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--queries', type=int, default=20, help='queries of each kind')
+    parser.add_argument('--plot-dist', type=int, default=500)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--derive', action='store_true', help='also time Graph.derive')
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+                        help='skip the second build that measures peak memory')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='file for the results, instead of stdout')
+    args = parser.parse_args()
+
+    # Render on blank tiles from an empty cache, so runs are comparable
+    os.environ[c.TILE_OFFLINE_ENV] = '1'
+    os.environ[c.TILE_DIR_ENV] = tempfile.mkdtemp(prefix='graphbot-tiles-')
+
+    import dataset
+
+    if args.dataset:
+        cities, seconds = timed(dataset.parse, args.dataset, min(args.pop))
+        source = {'dataset': args.dataset, 'parse_seconds': seconds}
+    else:
+        cities, seconds = timed(
+            synthetic_cities, args.cities, args.clusters, args.spread,
+            args.clustered, args.seed
+        )
+        source = {
+            'cities': args.cities, 'clusters': args.clusters,
+            'spread': args.spread, 'clustered': args.clustered,
+            'seed': args.seed, 'generate_seconds': seconds
+        }
+
+    rng = np.random.RandomState(args.seed)
+    results = [
+        bench_graph(cities, max_dist, min_pop, args, rng)
+        for max_dist in args.dist for min_pop in args.pop
+    ]
+    shutil.rmtree(os.environ[c.TILE_DIR_ENV], ignore_errors=True)
+
+    report = {
+        'source': source,
+        'queries': args.queries,
+        'plot_dist': args.plot_dist,
+        'workers': args.workers,
+        'python': sys.version.split()[0],
+        'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024,
+        'results': results
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
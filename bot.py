@@ -1,11 +1,29 @@
 '''
 Bot-related code
 '''
+import logging
+import os
+import time
+from io import BytesIO
+
+# Taken before the other imports, which are part of the startup time
+STARTED = time.monotonic()
+
 import telegram
-from telegram.ext import Updater, CommandHandler, Filters, MessageHandler
+from telegram.ext import Updater, CommandHandler, Filters, MessageHandler, TypeHandler
 
 import constants as c
-from graph import Graph
+import metrics
+import workers
+from graph import get_graph
+
+
+# Pool that builds graphs and renders maps, started by main
+pool = None
+
+# Seconds from the start of the process until the bot polls Telegram and
+# until it answers its first update
+startup = {'polling': None, 'first_response': None}
 
 
 def start_first(func):
@@ -26,16 +44,85 @@ def start_first(func):
     return wrapper
 
 
+def run_job(bot, update, command, callback, func, *args):
+    '''
+    Runs func(*args) in the worker pool and calls callback(result) with
+    its result, telling the user if the pool is busy or the job fails.
+    The time until the answer is recorded as the latency of command
+    '''
+    chat_id = update.message.chat_id
+    start = time.perf_counter()
+
+    def done(result, error):
+        if error:
+            logging.error('Job %s failed: %r', func.__name__, error)
+            bot.send_message(chat_id=chat_id, text=c.JOB_FAILED)
+        else:
+            callback(result)
+        metrics.observe('command.' + command, time.perf_counter() - start)
+
+    if not pool.submit(chat_id, done, func, *args):
+        bot.send_message(chat_id=chat_id, text=c.BUSY_TEXT)
+
+
+def send_image(bot, chat_id, image):
+    '''
+    Sends the PNG bytes image, or a message if there is nothing to plot
+    '''
+    if image is None:
+        bot.send_message(chat_id=chat_id, text=c.NO_IMAGE)
+        return
+    photo = BytesIO(image)
+    photo.name = 'map.png'
+    bot.send_photo(chat_id=chat_id, photo=photo)
+
+
+def first_response(bot, update):
+    '''
+    Records the time to the first answer of the bot. It runs after the
+    handlers of each update, so only the first call counts
+    '''
+    if startup['first_response'] is None:
+        startup['first_response'] = time.monotonic() - STARTED
+        metrics.observe('startup.first_response', startup['first_response'])
+        logging.info('First response %.3f s after start', startup['first_response'])
+
+
+def prewarm():
+    '''
+    Opens (or builds) the default graph in this process and in the worker
+    processes, so that the first commands do not wait for it
+    '''
+    try:
+        get_graph()
+        pool.warm_up(workers.build_job, c.MAX_DISTANCE, c.MIN_POPULATION)
+        logging.info('Default graph ready %.3f s after start', time.monotonic() - STARTED)
+    except Exception:
+        logging.exception('Could not prewarm the default graph')
+
+
+def graph_key(user_data):
+    '''
+    Returns the parameters of the graph of the user. Chats keep only
+    these, so that the registry can free the graphs they do not use
+    '''
+    return user_data['graph']
+
+
 # Bot functions
 def start(bot, update, user_data):
     '''
-    Writes a Hello message
+    Writes a Hello message once the default graph is ready
     '''
-    user_data['graph'] = Graph()
-    user_data['usercoords'] = None
-    bot.send_message(chat_id=update.message.chat_id, text=c.HELLO_TEXT)
+    def built(result):
+        user_data['graph'] = (c.MAX_DISTANCE, c.MIN_POPULATION)
+        user_data['usercoords'] = None
+        bot.send_message(chat_id=update.message.chat_id, text=c.HELLO_TEXT)
 
+    run_job(bot, update, 'start', built, workers.build_job, c.MAX_DISTANCE, c.MIN_POPULATION)
 
+
+@metrics.timer('command.help')
 @start_first
 def bot_help(bot, update, user_data):
     '''
@@ -48,6 +135,7 @@ def bot_help(bot, update, user_data):
     )
 
 
+@metrics.timer('command.author')
 @start_first
 def author(bot, update, user_data):
     '''
@@ -89,23 +177,37 @@ def change_graph(bot, update, user_data, args):
             bot.send_message(chat_id=update.message.chat_id, text=c.TOO_LOW_POPULATION)
             return
 
-        user_data['graph'] = Graph(int(args[0]), int(args[1]))
-        bot.send_message(chat_id=update.message.chat_id, text=c.OK_TEXT)
+        max_dist, min_pop = int(args[0]), int(args[1])
+
+        def built(result):
+            user_data['graph'] = (max_dist, min_pop)
+            bot.send_message(chat_id=update.message.chat_id, text=c.OK_TEXT)
+
+        run_job(bot, update, 'graph', built, workers.build_job, max_dist, min_pop)
 
     except ValueError:
         bot.send_message(chat_id=update.message.chat_id, text=c.WRONG_ARGS)
         return
 
 
+def send_count(bot, update, user_data, command, count):
+    '''
+    Writes the result of the count method of the graph of the user, got
+    in the worker pool
+    '''
+    run_job(
+        bot, update, command,
+        lambda result: bot.send_message(chat_id=update.message.chat_id, text=str(result)),
+        workers.count_job, graph_key(user_data), count
+    )
+
+
 @start_first
 def nodes(bot, update, user_data):
     '''
     Writes the number of nodes of the current graph
     '''
-    bot.send_message(
-        chat_id=update.message.chat_id,
-        text=str(user_data['graph'].get_number_nodes())
-    )
+    send_count(bot, update, user_data, 'nodes', 'get_number_nodes')
 
 
 @start_first
@@ -113,10 +215,7 @@ def edges(bot, update, user_data):
     '''
     Writes the number of edges of the current graph
     '''
-    bot.send_message(
-        chat_id=update.message.chat_id,
-        text=str(user_data['graph'].get_number_edges())
-    )
+    send_count(bot, update, user_data, 'edges', 'get_number_edges')
 
 
 @start_first
@@ -124,12 +223,10 @@ def components(bot, update, user_data):
     '''
     Writes the number of connected components of the graph
     '''
-    bot.send_message(
-        chat_id=update.message.chat_id,
-        text=str(user_data['graph'].get_number_components())
-    )
+    send_count(bot, update, user_data, 'components', 'get_number_components')
 
 
+@metrics.timer('command.location')
 @start_first
 def where(bot, update, user_data):
     '''
@@ -214,10 +311,11 @@ def plotpop(bot, update, user_data, args):
 
     dist, lat, lon = parsed_args
 
-    image = user_data['graph'].plotpop(lat, lon, dist)
-    if not image:
-        bot.send_message(chat_id=update.message.chat_id, text=c.NO_IMAGE)
-    bot.send_photo(chat_id=update.message.chat_id, photo=image)
+    run_job(
+        bot, update, 'plotpop',
+        lambda image: send_image(bot, update.message.chat_id, image),
+        workers.plot_job, graph_key(user_data), 'plotpop', lat, lon, dist
+    )
 
 
 @start_first
@@ -233,10 +331,11 @@ def plotgraph(bot, update, user_data, args):
 
     dist, lat, lon = parsed_args
 
-    image = user_data['graph'].plotgraph(lat, lon, dist)
-    if not image:
-        bot.send_message(chat_id=update.message.chat_id, text=c.NO_IMAGE)
-    bot.send_photo(chat_id=update.message.chat_id, photo=image)
+    run_job(
+        bot, update, 'plotgraph',
+        lambda image: send_image(bot, update.message.chat_id, image),
+        workers.plot_job, graph_key(user_data), 'plotgraph', lat, lon, dist
+    )
 
 
 def parse_route_args(bot, update, user_data, args):
@@ -266,33 +365,113 @@ def route(bot, update, user_data, args):
         )
         return
 
-    image = user_data['graph'].route(parsed_args[0], parsed_args[1])
-    if image == c.SOURCE_FAIL:
-        bot.send_message(
-            chat_id=update.message.chat_id,
-            text=c.NO_CITY.format(city=parsed_args[0])
-        )
-    elif image == c.DEST_FAIL:
-        bot.send_message(
-            chat_id=update.message.chat_id,
-            text=c.NO_CITY.format(city=parsed_args[1])
-        )
-    elif image == c.PATH_FAIL:
+    def routed(image):
+        if image == c.SOURCE_FAIL:
+            bot.send_message(
+                chat_id=update.message.chat_id,
+                text=c.NO_CITY.format(city=parsed_args[0])
+            )
+        elif image == c.DEST_FAIL:
+            bot.send_message(
+                chat_id=update.message.chat_id,
+                text=c.NO_CITY.format(city=parsed_args[1])
+            )
+        elif image == c.PATH_FAIL:
+            bot.send_message(
+                chat_id=update.message.chat_id,
+                text=c.NO_ROUTE
+            )
+        else:
+            send_image(bot, update.message.chat_id, image)
+
+    run_job(
+        bot, update, 'route', routed,
+        workers.route_job, graph_key(user_data), parsed_args[0], parsed_args[1]
+    )
+
+
+def parse_distances_args(bot, update, user_data, args):
+    '''
+    Parses args of function distances: the quoted source and targets
+    '''
+    cities = ' '.join(args).split('"')
+
+    if len(cities) % 2 == 0 or len(cities) < 5:
+        return
+
+    return cities[1], cities[3::2]
+
+
+def distances_text(dsts, lengths):
+    '''
+    Returns a line with the length of the route to each of dsts
+    '''
+    lines = []
+    for dst, length in zip(dsts, lengths):
+        if length == c.DEST_FAIL:
+            lines.append(c.NO_DISTANCE_CITY.format(city=dst))
+        elif length == c.PATH_FAIL:
+            lines.append(c.NO_DISTANCE_ROUTE.format(city=dst))
+        else:
+            lines.append(c.DISTANCE_TEXT.format(city=dst, dist=length))
+    return '\n'.join(lines)
+
+
+@start_first
+def distances(bot, update, user_data, args):
+    '''
+    Writes the length of the shortest route from args[0] to each of the
+    other cities in args
+    '''
+    parsed_args = parse_distances_args(bot, update, user_data, args)
+
+    if not parsed_args:
         bot.send_message(
             chat_id=update.message.chat_id,
-            text=c.NO_ROUTE
+            text=c.WRONG_ARGS
         )
-    else:
-        bot.send_photo(chat_id=update.message.chat_id, photo=image)
+        return
+
+    src, dsts = parsed_args
+
+    def answered(lengths):
+        if lengths and lengths[0] == c.SOURCE_FAIL:
+            text = c.NO_CITY.format(city=src)
+        else:
+            text = distances_text(dsts, lengths)
+        bot.send_message(chat_id=update.message.chat_id, text=text)
+
+    run_job(
+        bot, update, 'distances', answered,
+        workers.distances_job, graph_key(user_data), src, dsts
+    )
+
+
+def stats(bot, update):
+    '''
+    Writes the latency percentiles of the commands and stages, only to
+    the admins
+    '''
+    if not metrics.is_admin(update.message.chat_id):
+        return
+    bot.send_message(
+        chat_id=update.message.chat_id,
+        text='```\n' + metrics.report() + '\n```',
+        parse_mode=telegram.ParseMode.MARKDOWN
+    )
 
 
 def main():
     '''
     Main function
     '''
+    global pool
+    logging.basicConfig(level=logging.INFO)
     TOKEN = open('token.txt').read().strip()
+    pool = workers.WorkerPool()
 
-    updater = Updater(token=TOKEN)
+    api_url = os.environ.get(c.TELEGRAM_API_ENV)
+    updater = Updater(token=TOKEN, base_url=api_url.rstrip('/') + '/bot' if api_url else None)
     dispatcher = updater.dispatcher
 
     dispatcher.add_handler(CommandHandler('start', start, pass_user_data=True))
@@ -306,8 +485,22 @@ def main():
     dispatcher.add_handler(CommandHandler('plotpop', plotpop, pass_user_data=True, pass_args=True))
     dispatcher.add_handler(CommandHandler('plotgraph', plotgraph, pass_user_data=True, pass_args=True))
     dispatcher.add_handler(CommandHandler('route', route, pass_user_data=True, pass_args=True))
+    dispatcher.add_handler(CommandHandler('distances', distances, pass_user_data=True, pass_args=True))
+    dispatcher.add_handler(CommandHandler('stats', stats))
+    dispatcher.add_handler(TypeHandler(telegram.Update, first_response), group=1)
 
+    # Answer right away: updates are handled by the threads of the updater
+    # while this one loads the graphs
     updater.start_polling()
+    startup['polling'] = time.monotonic() - STARTED
+    metrics.observe('startup.polling', startup['polling'])
+    logging.info('Polling %.3f s after start', startup['polling'])
+    metrics.serve_from_env()
+    prewarm()
+
+    # The worker pool refuses jobs once the main thread exits
+    updater.idle()
+    pool.shutdown()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,98 @@
+'''
+Search index to find cities by approximate name
+'''
+import unicodedata
+from collections import defaultdict
+from functools import lru_cache
+
+import numpy as np
+from fuzzywuzzy import fuzz
+
+import constants as c
+
+
+def normalize(name):
+    '''
+    Returns name in lowercase, without accents and with single spaces
+    '''
+    decomposed = unicodedata.normalize('NFKD', str(name))
+    stripped = ''.join(ch for ch in decomposed if not unicodedata.combining(ch))
+    return ' '.join(stripped.lower().split())
+
+
+def trigrams(label):
+    '''
+    Returns the set of trigrams of label, padded so that short names and
+    word boundaries also have some
+    '''
+    padded = '  ' + label + ' '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class CityIndex:
+    '''
+    Finds the city whose "city, country" label is the most similar to a
+    query. Only the few cities sharing the most trigrams with the query
+    are scored with fuzz.ratio, and recent queries are cached
+    '''
+
+    def __init__(self, names):
+        # The label of each city is its name without the region
+        self.labels = [normalize(name.split(';')[0]) for name in names]
+
+        self.exact = dict()
+        self.prefixes = defaultdict(list)
+        postings = defaultdict(list)
+        for i, label in enumerate(self.labels):
+            self.exact.setdefault(label, i)
+            self.prefixes[label.split(',')[0]].append(i)
+            for gram in trigrams(label):
+                postings[gram].append(i)
+
+        self.postings = {
+            gram: np.array(ids, dtype=np.int64) for gram, ids in postings.items()
+        }
+        self.gram_counts = np.array(
+            [len(trigrams(label)) for label in self.labels], dtype=np.int64
+        )
+
+        self.lookup = lru_cache(maxsize=c.NAME_CACHE_SIZE)(self._lookup)
+
+    def _candidates(self, query):
+        '''
+        Returns the ids of the cities that share the most trigrams with
+        query, plus the ones whose city name is exactly query's
+        '''
+        grams = trigrams(query)
+        hits = [self.postings[gram] for gram in grams if gram in self.postings]
+        prefix = self.prefixes.get(query.split(',')[0], [])
+        if not hits:
+            return np.array(prefix, dtype=np.int64)
+
+        shared = np.bincount(np.concatenate(hits), minlength=len(self.labels))
+        sharing = np.nonzero(shared)[0]
+        dice = shared[sharing]/(self.gram_counts[sharing] + len(grams))
+        if len(sharing) > c.NAME_CANDIDATES:
+            best = np.argpartition(-dice, c.NAME_CANDIDATES)[:c.NAME_CANDIDATES]
+            sharing = sharing[best]
+        return np.union1d(sharing, np.array(prefix, dtype=np.int64))
+
+    def _lookup(self, name):
+        '''
+        Returns the id of the city most similar to name, or None if none is
+        similar enough
+        '''
+        query = normalize(name)
+        if query in self.exact:
+            return self.exact[query]
+
+        max_sim = -1
+        argmax = None
+        # Candidates are sorted, so ties are won by the lowest id
+        for i in self._candidates(query).tolist():
+            ratio = fuzz.ratio(self.labels[i], query)
+            if ratio > max_sim:
+                max_sim = ratio
+                argmax = i
+        if max_sim > c.NAME_MIN_SIMILARITY:
+            return argmax
@@ -1,6 +1,7 @@
 '''
 Constants for the GraphBot project
 '''
+import os
 
 # Graph-related constants
 URL = 'https://github.com/jordi-petit/lp-graphbot-2019/blob/master/dades/worldcitiespop.csv.gz?raw=true'
@@ -14,22 +15,162 @@ COLUMNS = {
     'Longitude': 5
 }
 
+# Types of the columns when parsing the dataset, which is read in chunks
+# of CSV_CHUNK_ROWS rows. Country and Region are then made categorical
+COLUMN_TYPES = {
+    'Country': 'str',
+    'AccentCity': 'str',
+    'Region': 'str',
+    'Population': 'float64',
+    'Latitude': 'float32',
+    'Longitude': 'float32'
+}
+CSV_CHUNK_ROWS = 200000
+
 MIN_POPULATION = 100000
 MAX_DISTANCE = 300
 CIRCLE_SCALE = 15
 
+# Map rendering
+MAP_SIZE = 400
+TILE_URL = 'https://a.tile.openstreetmap.org/{z}/{x}/{y}.png'
+TILE_SIZE = 256
+TILE_BLANK_COLOR = '#f2efe9'
+
+# Tile cache: directory (overridable with TILE_DIR_ENV) and size bound. If
+# TILE_OFFLINE_ENV is set tiles are never downloaded and missing ones are
+# drawn blank
+TILE_DIR = 'data/tiles/'
+TILE_DIR_ENV = 'GRAPHBOT_TILE_DIR'
+TILE_OFFLINE_ENV = 'GRAPHBOT_TILES_OFFLINE'
+TILE_CACHE_BYTES = 512*1024*1024
+
+# Tiles of a map: threads downloading them, tries per tile and seconds of
+# each request
+TILE_THREADS = 4
+TILE_RETRIES = 3
+TILE_TIMEOUT = 10
+
+# Level of detail: plots with more edges or cities than these snap edges
+# to a grid of LOD_PIXELS pixels (or coarser, to draw at most
+# LOD_MAX_SEGMENTS) and merge the cities in the same cell of
+# LOD_CIRCLE_PIXELS pixels
+LOD_MIN_EDGES = 2000
+LOD_MIN_CIRCLES = 1000
+LOD_PIXELS = 1
+LOD_MAX_SEGMENTS = 4000
+LOD_CIRCLE_PIXELS = 4
+
+# Largest number of pixels rasterized at once by render.ArrayMap
+RASTER_CHUNK = 1000000
+
+# Cache of rendered images: total size and decimals of the coordinates
+IMAGE_CACHE_BYTES = 64*1024*1024
+IMAGE_CACHE_DECIMALS = 2
+
+# Cache of computed routes: total size in memory and, if ROUTE_DIR_ENV is
+# set to a directory, on disk
+ROUTE_CACHE_BYTES = 32*1024*1024
+ROUTE_DIR_ENV = 'GRAPHBOT_ROUTE_DIR'
+ROUTE_CACHE_DISK_BYTES = 256*1024*1024
+
+# Cache directories shared by the processes (tiles, routes) are rescanned
+# every DISK_RESCAN_WRITES writes and when over their bound, and then
+# evicted down to DISK_LOW_WATER of it
+DISK_RESCAN_WRITES = 100
+DISK_LOW_WATER = 0.9
+
 CSV_DIR = 'data/'
 CSV_URI = CSV_DIR + 'citydata.csv.gz'
+CSV_META_URI = CSV_DIR + 'citydata.json'
+
+# Environment variable with the path of a local copy of the dataset; when
+# set, the dataset is never downloaded
+DATASET_ENV = 'GRAPHBOT_DATASET'
+DOWNLOAD_TIMEOUT = 60
+
+# Prebuilt graphs, one directory of .npy arrays per (max_dist, min_pop),
+# bounded by their total size
+SNAPSHOT_DIR = CSV_DIR + 'graphs/'
+SNAPSHOT_FORMAT = 6
+SNAPSHOT_CACHE_BYTES = 4*1024*1024*1024
+
+# Sharded graphs (built with shards.py), for the ones too large to keep in
+# memory: cells of at least SHARD_CELL_SIZE km (and max_dist), nodes plus
+# edges of the shards kept loaded by each graph and number of countries
+# whose name index is kept
+SHARD_DIR = CSV_DIR + 'shards/'
+SHARD_FORMAT = 2
+SHARD_CELL_SIZE = 1000
+SHARD_CACHE_ELEMENTS = 5000000
+SHARD_NAME_INDEXES = 16
 
 SOURCE_FAIL = 'Source Fail'
 DEST_FAIL = 'Dest Fail'
 PATH_FAIL = 'Paht Fail'
 
+# Bounds of the registry of shared graphs: number of graphs and total
+# number of nodes plus edges
+GRAPH_CACHE_SIZE = 64
+GRAPH_CACHE_ELEMENTS = 20000000
+
+# City name search: minimum fuzz.ratio to accept a match, number of
+# candidates scored per query and number of cached queries
+NAME_MIN_SIMILARITY = 80
+NAME_CANDIDATES = 32
+NAME_CACHE_SIZE = 4096
+
+# Routing: number of ALT landmarks per graph (0 disables them) and
+# relative slack of the A* heuristic for the float32 rounding of weights
+ROUTE_LANDMARKS = 4
+HEURISTIC_SLACK = 1e-6
+
 MAX_USER_DISTANCE = 1000
 MIN_USER_POPULATION = 80000
 
 EARTH_RADIUS = 6371.0
 
+# Maximum number of cities in each leaf of the kdtree
+KDTREE_LEAF_SIZE = 16
+
+# Maximum number of candidate pairs compared at once when building edges
+JOIN_CHUNK = 4000000
+
+# Smallest number of cities for which the graph is built in parallel, and
+# number of worker processes used by the shared graphs
+PARALLEL_MIN_CITIES = 20000
+BUILD_WORKERS = os.cpu_count() or 1
+
+# Worker pool for graph building and rendering: processes, total queued
+# jobs and queued jobs per chat
+RENDER_WORKERS = os.cpu_count() or 1
+MAX_QUEUED_JOBS = 256
+MAX_QUEUED_JOBS_PER_CHAT = 2
+
+# Threads that deliver the results of finished jobs (uploading the photos)
+CALLBACK_THREADS = 8
+
+# Telegram Bot API used by the bots (overridable with
+# TELEGRAM_API_ENV, e.g. to point it to fake_telegram.py) and seconds of
+# each long poll
+TELEGRAM_API = 'https://api.telegram.org'
+TELEGRAM_API_ENV = 'GRAPHBOT_API_URL'
+POLL_TIMEOUT = 30
+
+# Metrics: timings kept for the percentiles of each command or stage,
+# chat ids allowed to use /stats (comma separated) and port of the
+# optional metrics endpoint
+METRICS_SAMPLES = 1000
+ADMINS_ENV = 'GRAPHBOT_ADMINS'
+METRICS_PORT_ENV = 'GRAPHBOT_METRICS_PORT'
+
+# Profiler of slow requests, enabled by setting PROFILE_ENV to the number
+# of seconds from which a request is slow. Only a fraction PROFILE_RATE
+# of the requests are profiled
+PROFILE_ENV = 'GRAPHBOT_PROFILE'
+PROFILE_RATE = 0.1
+PROFILE_DIR = CSV_DIR + 'profiles/'
+
 # Bot-related constants
 NOT_STARTED = "You have not started a conversation with the bot! To start using it, use /start"
 
@@ -94,6 +235,11 @@ location (they must have been already specified with /setcoords).
 follow the format "city, country", where country refers to the \
 abbreviation (for example, Barcelona would be "Barcelona, es".
 
+- /distances ⟨src⟩ ⟨dst⟩ [[⟨dst⟩ ...]]
+
+    Writes the length of the shortest way from `⟨src⟩` to each of the \
+`⟨dst⟩`, with the cities in the same format as in /route.
+
 - Additionaly, you can send your location and the bot will start using it\
 when needed.
 """.format(
@@ -121,6 +267,16 @@ NO_CITY = "No cities were found matching the name {city}. Please use " + \
 
 NO_ROUTE = "No route was found between the given cities."
 
+DISTANCE_TEXT = "{city}: {dist:.0f} km"
+
+NO_DISTANCE_CITY = "{city}: city not found"
+
+NO_DISTANCE_ROUTE = "{city}: no route"
+
+BUSY_TEXT = "The bot is busy right now, please try again in a moment."
+
+JOB_FAILED = "Something went wrong processing your request, please try again."
+
 TOO_LARGE_DISTANCE = "Please set a distance less than {}".format(MAX_USER_DISTANCE)
 
 TOO_LOW_POPULATION = "Please set a population greater than {}".format(MIN_USER_POPULATION)
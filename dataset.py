@@ -0,0 +1,220 @@
+'''
+Loads the cities dataset, downloading and parsing it at most once per process
+'''
+import asyncio
+import json
+import os
+import threading
+
+import constants as c
+
+# pandas, requests and aiohttp are imported where they are used, so that
+# importing this module (and the bot) is fast
+
+
+_lock = threading.Lock()
+_cities = None
+# Population the cached cities were filtered with (None if not filtered)
+_floor = None
+
+
+def _read_meta():
+    '''
+    Returns the cache validators saved with the last download
+    '''
+    try:
+        with open(c.CSV_META_URI) as meta_file:
+            return json.load(meta_file)
+    except (OSError, ValueError):
+        return dict()
+
+
+def _write_meta(headers):
+    '''
+    Saves the cache validators of the response headers next to the dataset
+    '''
+    meta = {
+        'etag': headers.get('ETag'),
+        'last_modified': headers.get('Last-Modified')
+    }
+    with open(c.CSV_META_URI, 'w') as meta_file:
+        json.dump(meta, meta_file)
+
+
+def _conditional_headers():
+    '''
+    Returns the request headers to revalidate the local copy, creating
+    the data directory if needed
+    '''
+    if not os.path.exists(c.CSV_DIR):
+        os.makedirs(c.CSV_DIR)
+
+    headers = dict()
+    if os.path.exists(c.CSV_URI):
+        meta = _read_meta()
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+    return headers
+
+
+def _save(content, headers):
+    '''
+    Writes a new copy of the dataset and its cache validators
+    '''
+    # Write to a temporary file first so readers never see a partial file
+    tmp_uri = c.CSV_URI + '.tmp'
+    with open(tmp_uri, 'wb') as csv_file:
+        csv_file.write(content)
+    os.replace(tmp_uri, c.CSV_URI)
+    _write_meta(headers)
+
+
+def local_path():
+    '''
+    Returns the path of the local dataset given in the offline
+    environment variable, or None when running online
+    '''
+    return os.environ.get(c.DATASET_ENV) or None
+
+
+def version():
+    '''
+    Returns a string identifying the local copy of the dataset, without
+    any network access
+    '''
+    offline = local_path()
+    if offline:
+        try:
+            stat = os.stat(offline)
+        except OSError:
+            return None
+        return '{}:{}:{}'.format(offline, stat.st_size, int(stat.st_mtime))
+
+    meta = _read_meta()
+    return meta.get('etag') or meta.get('last_modified')
+
+
+def fetch():
+    '''
+    Returns the path of an up-to-date copy of the dataset. The copy on
+    disk is revalidated with ETag/If-Modified-Since and only downloaded
+    again if the server has a newer one
+    '''
+    offline = local_path()
+    if offline:
+        return offline
+
+    import requests
+
+    headers = _conditional_headers()
+    try:
+        r = requests.get(c.URL, headers=headers, timeout=c.DOWNLOAD_TIMEOUT)
+        r.raise_for_status()
+    except requests.RequestException:
+        # Serve the stale copy rather than failing if we have one
+        if os.path.exists(c.CSV_URI):
+            return c.CSV_URI
+        raise
+
+    if r.status_code == 304:
+        return c.CSV_URI
+
+    _save(r.content, r.headers)
+    return c.CSV_URI
+
+
+async def fetch_async(session):
+    '''
+    Same as fetch, but downloading with the aiohttp session
+    '''
+    offline = local_path()
+    if offline:
+        return offline
+
+    import aiohttp
+
+    headers = _conditional_headers()
+    try:
+        async with session.get(c.URL, headers=headers, timeout=c.DOWNLOAD_TIMEOUT) as r:
+            if r.status == 304:
+                return c.CSV_URI
+            r.raise_for_status()
+            content = await r.read()
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        # Serve the stale copy rather than failing if we have one
+        if os.path.exists(c.CSV_URI):
+            return c.CSV_URI
+        raise
+
+    _save(content, r.headers)
+    return c.CSV_URI
+
+
+def parse(path, min_pop=None):
+    '''
+    Reads the cities in path with known population, and only the ones
+    with population larger than min_pop if given. The file is parsed in
+    chunks that are filtered right away, so the memory used depends on
+    the cities kept rather than on the size of the file
+    '''
+    import pandas as pd
+
+    chunks = pd.read_csv(
+        path,
+        usecols=c.COLUMNS.keys(),
+        dtype=c.COLUMN_TYPES,
+        compression='gzip',
+        chunksize=c.CSV_CHUNK_ROWS
+    )
+    kept = []
+    for chunk in chunks:
+        population = chunk['Population']
+        kept.append(chunk[population.notna() if min_pop is None else population > min_pop])
+
+    dataframe = pd.concat(kept, ignore_index=True)
+    for column in ('Country', 'Region'):
+        dataframe[column] = dataframe[column].astype('category')
+    return dataframe
+
+
+def _covers(floor, min_pop):
+    '''
+    Returns True if the cities filtered with floor include all the ones
+    with population larger than min_pop
+    '''
+    return floor is None or (min_pop is not None and floor <= min_pop)
+
+
+def _load(path=None, min_pop=None):
+    '''
+    Parses the dataset in path (fetching it if not given) unless the
+    process already did with a lower population floor
+    '''
+    global _cities, _floor
+    with _lock:
+        if _cities is None or not _covers(_floor, min_pop):
+            _cities = parse(path or fetch(), min_pop)
+            _floor = min_pop
+        return _cities
+
+
+def load_cities(min_pop=None):
+    '''
+    Returns the cities DataFrame shared by all the graphs of the process.
+    It has at least the cities with population larger than min_pop, or
+    all the ones with known population if not given
+    '''
+    return _load(min_pop=min_pop)
+
+
+async def load_cities_async(session, min_pop=None):
+    '''
+    Same as load_cities, downloading with the aiohttp session and parsing
+    in a thread so the event loop is not blocked
+    '''
+    if _cities is not None and _covers(_floor, min_pop):
+        return _cities
+    path = await fetch_async(session)
+    return await asyncio.get_running_loop().run_in_executor(None, _load, path, min_pop)
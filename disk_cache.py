@@ -0,0 +1,137 @@
+'''
+Size-bounded cache directories, shared by all the processes of the bot
+'''
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+import constants as c
+
+
+class DiskCache:
+    '''
+    Files with the given suffix under a directory, bounded by their total
+    size and evicting the least recently used ones (reads refresh their
+    modification time). Other processes write to the same directory, so
+    it is rescanned before evicting and every DISK_RESCAN_WRITES writes,
+    and eviction goes down to DISK_LOW_WATER of the bound
+    '''
+
+    def __init__(self, path, max_bytes, suffix):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self.lock = threading.Lock()
+        # Files in LRU order (oldest first) with their sizes
+        self.files = OrderedDict()
+        self.total = 0
+        self.writes = 0
+        self.scan()
+
+    def entries(self):
+        '''
+        Yields the (modification time, path, size) of the files in the
+        directory
+        '''
+        for root, _, names in os.walk(self.path):
+            for name in names:
+                if name.endswith(self.suffix):
+                    file_path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(file_path)
+                    except OSError:
+                        # Removed by another process
+                        continue
+                    yield stat.st_mtime, file_path, stat.st_size
+
+    def remove(self, file_path):
+        '''
+        Deletes an evicted file
+        '''
+        try:
+            os.remove(file_path)
+        except OSError:
+            pass
+
+    def scan(self):
+        '''
+        Rebuilds the list of files from the directory
+        '''
+        files = OrderedDict()
+        for _, file_path, size in sorted(self.entries()):
+            files[file_path] = size
+        with self.lock:
+            self.files = files
+            self.total = sum(files.values())
+
+    def touch(self, file_path):
+        '''
+        Marks a file as recently used
+        '''
+        with self.lock:
+            if file_path in self.files:
+                self.files.move_to_end(file_path)
+        try:
+            os.utime(file_path)
+        except OSError:
+            pass
+
+    def add(self, file_path, size):
+        '''
+        Records a written file, evicting the least recently used ones if
+        the directory is over its bound
+        '''
+        with self.lock:
+            self.total += size - self.files.pop(file_path, 0)
+            self.files[file_path] = size
+            self.writes += 1
+            rescan = self.total > self.max_bytes or self.writes % c.DISK_RESCAN_WRITES == 0
+        if not rescan:
+            return
+
+        self.scan()
+        with self.lock:
+            if self.total <= self.max_bytes:
+                return
+            while self.total > self.max_bytes*c.DISK_LOW_WATER and len(self.files) > 1:
+                old_path, old_size = self.files.popitem(last=False)
+                self.total -= old_size
+                self.remove(old_path)
+
+
+class DirectoryCache(DiskCache):
+    '''
+    DiskCache whose entries are the subdirectories of the directory with
+    the given suffix, each with all the files inside it. Temporary ones
+    (*.tmp), still being written, are left alone
+    '''
+
+    def size(self, entry_path):
+        '''
+        Returns the total size of the files of an entry
+        '''
+        return sum(
+            os.path.getsize(os.path.join(root, name))
+            for root, _, names in os.walk(entry_path)
+            for name in names
+        )
+
+    def entries(self):
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return
+        for name in names:
+            entry_path = os.path.join(self.path, name)
+            if not name.endswith(self.suffix) or name.endswith('.tmp') or \
+                    not os.path.isdir(entry_path):
+                continue
+            try:
+                yield os.stat(entry_path).st_mtime, entry_path, self.size(entry_path)
+            except OSError:
+                # Removed by another process
+                continue
+
+    def remove(self, entry_path):
+        shutil.rmtree(entry_path, ignore_errors=True)
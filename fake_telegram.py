@@ -0,0 +1,216 @@
+'''
+Local fake of the Telegram Bot API, to run and load-test the bot without
+the network
+'''
+import argparse
+import asyncio
+import json
+import multiprocessing
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import aiohttp
+from aiohttp import web
+
+import constants as c
+
+
+class FakeTelegram:
+    '''
+    Serves getMe, getUpdates, sendMessage and sendPhoto. Tests inject user
+    messages with send and wait for the bot replies with wait_replies
+    '''
+
+    def __init__(self):
+        self.updates = []
+        self.next_update_id = 1
+        self.new_updates = asyncio.Condition()
+        self.replies = defaultdict(list)
+        self.new_replies = asyncio.Condition()
+
+        self.app = web.Application()
+        self.app.router.add_post('/bot{token}/{method}', self.api)
+        self.app.router.add_get('/bot{token}/{method}', self.api)
+
+    async def send(self, chat_id, text=None, location=None):
+        '''
+        Queues a message from the user of chat_id
+        '''
+        message = {
+            'message_id': self.next_update_id,
+            'chat': {'id': chat_id, 'type': 'private'},
+            'date': int(time.time())
+        }
+        if text is not None:
+            message['text'] = text
+        if location is not None:
+            message['location'] = {'latitude': location[0], 'longitude': location[1]}
+
+        async with self.new_updates:
+            self.updates.append({'update_id': self.next_update_id, 'message': message})
+            self.next_update_id += 1
+            self.new_updates.notify_all()
+
+    async def wait_replies(self, chat_id, count, timeout=None):
+        '''
+        Waits until chat_id has count replies and returns them
+        '''
+        async with self.new_replies:
+            await asyncio.wait_for(
+                self.new_replies.wait_for(lambda: len(self.replies[chat_id]) >= count),
+                timeout
+            )
+            return self.replies[chat_id][:count]
+
+    async def api(self, request):
+        '''
+        Handles a call to the Bot API
+        '''
+        method = request.match_info['method']
+        if request.content_type == 'multipart/form-data':
+            params = dict()
+            async for field in await request.multipart():
+                params[field.name] = await field.read() if field.filename \
+                    else await field.text()
+        else:
+            body = await request.text()
+            params = json.loads(body) if body else dict(request.query)
+
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'graphbot', 'username': 'graphbot'}
+        elif method == 'getUpdates':
+            result = await self.get_updates(params)
+        elif method in ('sendMessage', 'sendPhoto'):
+            result = await self.reply(method, params)
+        else:
+            return web.json_response({'ok': False, 'description': 'Unknown method'})
+        return web.json_response({'ok': True, 'result': result})
+
+    async def get_updates(self, params):
+        '''
+        Returns the updates from offset on, waiting up to timeout seconds
+        for some to arrive
+        '''
+        # Form-encoded calls send every parameter as text
+        offset = int(params.get('offset') or 0)
+        async with self.new_updates:
+            # Updates before offset are confirmed and can be forgotten
+            self.updates = [u for u in self.updates if u['update_id'] >= offset]
+            if not self.updates:
+                try:
+                    await asyncio.wait_for(
+                        self.new_updates.wait_for(lambda: self.updates),
+                        float(params.get('timeout') or 0)
+                    )
+                except asyncio.TimeoutError:
+                    pass
+            return list(self.updates)
+
+    async def reply(self, method, params):
+        '''
+        Records a message sent by the bot
+        '''
+        chat_id = int(params['chat_id'])
+        reply = {
+            'time': time.monotonic(),
+            'method': method,
+            'text': params.get('text'),
+            'photo_bytes': len(params.get('photo') or b'')
+        }
+        async with self.new_replies:
+            self.replies[chat_id].append(reply)
+            self.new_replies.notify_all()
+        return {
+            'message_id': len(self.replies[chat_id]),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'date': int(time.time())
+        }
+
+
+def percentile(values, q):
+    '''
+    Returns the q-th percentile of values
+    '''
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(int(q/100*len(values)), len(values) - 1)]
+
+
+async def load_test(chats, commands, port, timeout):
+    '''
+    Runs the async bot against the fake API and sends /start plus the
+    commands from each of the chats at once. Returns the latency of every
+    command, in seconds, grouped by command
+    '''
+    import async_bot
+
+    fake = FakeTelegram()
+    runner = web.AppRunner(fake.app)
+    await runner.setup()
+    await web.TCPSite(runner, 'localhost', port).start()
+
+    executor = ProcessPoolExecutor(
+        c.RENDER_WORKERS, mp_context=multiprocessing.get_context('spawn')
+    )
+    session = aiohttp.ClientSession()
+    api_url = 'http://localhost:{}'.format(port)
+    client = async_bot.TelegramClient(session, 'fake', api_url)
+    bot = async_bot.AsyncBot(client, session, executor)
+    poller = asyncio.ensure_future(bot.poll())
+
+    latencies = defaultdict(list)
+
+    async def chat(chat_id):
+        for count, text in enumerate(['/start'] + commands, 1):
+            sent = time.monotonic()
+            await fake.send(chat_id, text)
+            replies = await fake.wait_replies(chat_id, count, timeout)
+            latencies[text.split()[0]].append(replies[-1]['time'] - sent)
+
+    try:
+        await asyncio.gather(*(chat(chat_id) for chat_id in range(1, chats + 1)))
+    finally:
+        poller.cancel()
+        await session.close()
+        await runner.cleanup()
+        executor.shutdown()
+    return latencies
+
+
+def main():
+    '''
+    Command line tool: serves the fake API, or runs a load test
+    '''
+    parser = argparse.ArgumentParser(description='Fake Telegram Bot API')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--serve', action='store_true', help='only serve the fake API')
+    parser.add_argument('--chats', type=int, default=100)
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('commands', nargs='*', default=['/nodes', '/plotpop 500 41.4 2.2'])
+    args = parser.parse_args()
+
+    if args.serve:
+        web.run_app(FakeTelegram().app, host='localhost', port=args.port)
+        return
+
+    start = time.monotonic()
+    latencies = asyncio.run(load_test(args.chats, args.commands, args.port, args.timeout))
+    elapsed = time.monotonic() - start
+
+    results = {
+        command: {
+            'count': len(values),
+            'p50': percentile(values, 50),
+            'p99': percentile(values, 99),
+            'max': max(values)
+        }
+        for command, values in latencies.items()
+    }
+    results['total_seconds'] = elapsed
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
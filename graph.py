@@ -1,207 +1,735 @@
 '''
 Class that stores the graph and handles all its functions
 '''
-import csv
+import json
 import logging
-import gzip
-import requests
 import os
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
 from io import BytesIO
 
-import pandas as pd
-import networkx as nx
-from haversine import haversine
-from staticmap import StaticMap, Line, CircleMarker
-from fuzzywuzzy import fuzz
+import numpy as np
 
 import constants as c
+import dataset
+import disk_cache
 import graph_utilities as gu
+import metrics
+import route_cache
+import routing
 
+# networkx, the name index and the renderer (with fuzzywuzzy, staticmap
+# and Pillow) are imported on first use, so that the bot starts quickly
 
-class Graph:
+
+class GraphQueries:
     '''
-    Class that stores the graph and handles all its functions
+    Counts, plots and routes of a graph, in terms of the cities of its
+    subclasses (names, lats, lons, pops, version and n_components) and of
+    their cities_within, edges_between, get_city_id, shortest_paths and
+    get_number_edges
     '''
 
-    def __init__(self, max_dist=c.MAX_DISTANCE, min_pop=c.MIN_POPULATION):
-        '''
-        Downloads the data and creates the graph
-        '''
-
-        # Download the data and process it
-        if not os.path.exists(c.CSV_DIR):
-            os.makedirs(c.CSV_DIR)
-        if os.path.exists(c.CSV_URI):
-            os.remove(c.CSV_URI)
-        r = requests.get(c.URL)
-        open(c.CSV_URI, 'wb').write(r.content)
-
-        dataframe = pd.read_csv(
-            c.CSV_URI,
-            usecols=c.COLUMNS.keys(),
-            compression='gzip'
-        )
-        dataframe = dataframe[dataframe['Population'] > min_pop]
-
-        self.coordinates = dict()
-        self.populations = dict()
-        for row in dataframe.iterrows():
-            info = row[1]
-            city = info[c.COLUMNS['AccentCity']]
-            country = info[c.COLUMNS['Country']]
-            region = info[c.COLUMNS['Region']]
-            key = '{city}, {country}; {region}'.format(
-                city=city,
-                country=country,
-                region=region
-            )
-            self.coordinates[key] = (
-                info[c.COLUMNS['Latitude']],
-                info[c.COLUMNS['Longitude']]
-            )
-            self.populations[key] = info[c.COLUMNS['Population']]
-
-        # Create the graph
-        self.G = gu.build_graph(self.coordinates, max_dist)
-
     def get_number_nodes(self):
         '''
         Returns the number of nodes in the graph
         '''
-        return len(self.G.nodes)
-
-    def get_number_edges(self):
-        '''
-        Returns the number of edges in the graph
-        '''
-        return len(self.G.edges)
+        return len(self.names)
 
     def get_number_components(self):
         '''
-        Returns the number of edges in the graph
-        '''
-        return len(list(nx.connected_components(self.G)))
-
-    def is_plottable(self, edge, coords, dist):
-        '''
-        Returs True if the distance between each of the two points in the
-        edge and the point coords is lower than dist
+        Returns the number of connected components of the graph
         '''
-        dist0 = haversine(self.coordinates[edge[0]], coords)
-        dist1 = haversine(self.coordinates[edge[1]], coords)
-        return dist0 <= dist and dist1 <= dist
+        return self.n_components
 
     def plotgraph(self, lat, lon, dist):
         '''
         Returns the plot of the graph of the edges between cities that
         have distance than dist from (lat, lon)
         '''
-        mapa = StaticMap(400, 400)
-        some = False
+        import render
+
+        lat, lon = render.round_coords(lat, lon)
+        return render.images.get_or_render(
+            (self.version, 'plotgraph', lat, lon, dist),
+            lambda: self._plotgraph(lat, lon, dist)
+        )
 
-        for edge in self.G.edges:
-            if self.is_plottable(edge, (lat, lon), dist):
-                some = True
-                # Staticmap needs coordinates in order (Longitude, Latitude)
-                rev_coords_0 = tuple(reversed(self.coordinates[edge[0]]))
-                rev_coords_1 = tuple(reversed(self.coordinates[edge[1]]))
-                mapa.add_line(Line((rev_coords_0, rev_coords_1), 'blue', 3))
+    def _plotgraph(self, lat, lon, dist):
+        '''
+        Renders the plot returned by plotgraph
+        '''
+        with metrics.timer('plotgraph.select'):
+            ids = self.cities_within(lat, lon, dist)
+            src, dst = self.edges_between(ids)
 
-        if not some:
+        if len(src) == 0:
             return
 
-        image = mapa.render()
-        bio = BytesIO()
-        bio.name = 'map.png'
-        image.save(bio)
-        bio.seek(0)
-        return bio
+        return plot_edges(self.lats[src], self.lons[src], self.lats[dst], self.lons[dst])
 
     def plotpop(self, lat, lon, dist):
         '''
         Returns the plot of the graph of the cities that have distance
         lower than dist from (lat, lon)
         '''
-        mapa = StaticMap(400, 400)
-        some = False
+        import render
 
-        max_pop = 0
-        for node in self.G.nodes:
-            if self.is_plottable((node, node), (lat, lon), dist):
-                some = True
-                if max_pop < self.populations[node]:
-                    max_pop = self.populations[node]
+        lat, lon = render.round_coords(lat, lon)
+        return render.images.get_or_render(
+            (self.version, 'plotpop', lat, lon, dist),
+            lambda: self._plotpop(lat, lon, dist)
+        )
+
+    def _plotpop(self, lat, lon, dist):
+        '''
+        Renders the plot returned by plotpop
+        '''
+        with metrics.timer('plotpop.select'):
+            ids = self.cities_within(lat, lon, dist)
 
-        if not some:
+        if len(ids) == 0:
             return
 
-        for node in self.G.nodes:
-            if self.is_plottable((node, node), (lat, lon), dist):
-                rev_coords = tuple(reversed(self.coordinates[node]))
-                circle = CircleMarker(
-                    rev_coords,
-                    'red',
-                    self.populations[node]*c.CIRCLE_SCALE/max_pop
-                )
-                mapa.add_marker(circle)
-
-        image = mapa.render()
-        bio = BytesIO()
-        bio.name = 'map.png'
-        image.save(bio)
-        bio.seek(0)
-        return bio
+        return plot_cities(self.lats[ids], self.lons[ids], self.pops[ids])
 
     def get_most_similar(self, name):
         '''
         Returns the most similar city name in G to name
         '''
-        max_sim = -1
-        argmax = None
-        for city in self.G.nodes:
-            ratio = fuzz.ratio(city.split(';')[0], name)
-            if ratio > max_sim:
-                max_sim = ratio
-                argmax = city
-        if max_sim > 80:
-            return argmax
+        city = self.get_city_id(name)
+        if city is not None:
+            return self.names[city]
+
+    def get_city_ids(self, names):
+        '''
+        Returns the ids of the most similar cities in G to each of names,
+        None for the ones without a match. Repeated names are searched once
+        '''
+        ids = {name: self.get_city_id(name) for name in set(names)}
+        return [ids[name] for name in names]
+
+    def routes(self, pairs):
+        '''
+        Returns, for each (src, dst) pair of city names, the (length, list
+        of city ids) of the shortest route between them or, as route,
+        SOURCE_FAIL, DEST_FAIL or PATH_FAIL. Names are resolved at once and
+        the pairs with the same source share a single search
+        '''
+        with metrics.timer('routes.names'):
+            ids = self.get_city_ids([name for pair in pairs for name in pair])
+        srcs, dsts = ids[0::2], ids[1::2]
+
+        # Cached routes are not searched again
+        routes = route_cache.get_route_cache()
+        found = dict()
+        targets = dict()
+        for src, dst in zip(srcs, dsts):
+            if src is None or dst is None or (src, dst) in found:
+                continue
+            cached = routes.get(self.version, src, dst)
+            if cached is not None:
+                found[src, dst] = cached[:2]
+            else:
+                targets.setdefault(src, set()).add(dst)
+
+        with metrics.timer('routes.paths'):
+            for src, group in targets.items():
+                group = list(group)
+                for dst, result in zip(group, self.shortest_paths(src, group)):
+                    found[src, dst] = result
+                    if result is not None:
+                        routes.put(self.version, src, dst, *result)
+
+        results = []
+        for src, dst in zip(srcs, dsts):
+            if src is None:
+                results.append(c.SOURCE_FAIL)
+            elif dst is None:
+                results.append(c.DEST_FAIL)
+            else:
+                results.append(found[src, dst] or c.PATH_FAIL)
+        return results
+
+    def distances(self, src, dsts):
+        '''
+        Returns the routes, as routes, from the city name src to each of
+        the city names dsts
+        '''
+        return self.routes([(src, dst) for dst in dsts])
 
     def route(self, src, dst):
         '''
-        Returns the plot of the shortest route between src and dst
-        '''
-        real_src = self.get_most_similar(src)
-        real_dst = self.get_most_similar(dst)
-
-        if real_src and real_dst:
-            try:
-                path = nx.algorithms.shortest_paths.generic.shortest_path(
-                    self.G,
-                    source=real_src,
-                    target=real_dst,
-                    weight='weight'
-                )
-            except Exception as e:
-                return c.PATH_FAIL
-
-            mapa = StaticMap(400, 400)
-            for cities in zip(['']+path, path):
-                rev_coords_1 = tuple(reversed(self.coordinates[cities[1]]))
-                circle = CircleMarker(rev_coords_1, 'red', 4)
-                mapa.add_marker(circle)
-                if '' in cities:
-                    continue
-                rev_coords_0 = tuple(reversed(self.coordinates[cities[0]]))
-                mapa.add_line(Line((rev_coords_0, rev_coords_1), 'blue', 3))
-
-            image = mapa.render()
-            bio = BytesIO()
+        Returns the plot of the shortest route between src and dst. Routes
+        and their plots are cached by the ids of the cities
+        '''
+        with metrics.timer('route.names'):
+            real_src = self.get_city_id(src)
+            real_dst = self.get_city_id(dst)
+
+        if real_src is not None and real_dst is not None:
+            routes = route_cache.get_route_cache()
+            cached = routes.get(self.version, real_src, real_dst)
+            if cached is not None:
+                length, path, image = cached
+            else:
+                with metrics.timer('route.path'):
+                    found = self.shortest_paths(real_src, [real_dst])[0]
+                if found is None:
+                    return c.PATH_FAIL
+                length, path = found
+                image = None
+
+            if image is None:
+                image = plot_path(self.lats[path], self.lons[path]).getvalue()
+                routes.put(self.version, real_src, real_dst, length, path, image)
+
+            bio = BytesIO(image)
             bio.name = 'map.png'
-            image.save(bio)
-            bio.seek(0)
             return bio
 
-        if not real_src:
+        if real_src is None:
             return c.SOURCE_FAIL
 
         return c.DEST_FAIL
+
+
+class Graph(GraphQueries):
+    '''
+    Class that stores the graph and handles all its functions
+    '''
+
+    # Sharded graphs (see shards.py) keep their cities on disk
+    sharded = False
+
+    def __init__(self, max_dist=c.MAX_DISTANCE, min_pop=c.MIN_POPULATION, cities=None, workers=1):
+        '''
+        Creates the graph from the cities DataFrame, which by default is
+        the dataset shared by the whole process. With more than one worker
+        the edges are computed in a pool of processes
+        '''
+        with metrics.timer('graph.cities'):
+            if cities is None:
+                cities = dataset.load_cities(min_pop)
+
+            # Node i of the graph is the city in row i of dataframe
+            dataframe, keys = select_cities(cities, min_pop)
+            self.names = gu.NameTable.from_strings(keys)
+            self.lats = dataframe['Latitude'].to_numpy(dtype=float)
+            self.lons = dataframe['Longitude'].to_numpy(dtype=float)
+            self.pops = dataframe['Population'].to_numpy(dtype=float)
+
+        self.max_dist = max_dist
+        self.min_pop = min_pop
+        self.version = uuid.uuid4().hex
+        self._coordinates = None
+        self._populations = None
+
+        # Create the graph
+        with metrics.timer('graph.edges'):
+            edges = gu.build_edges(self.lats, self.lons, max_dist, workers)
+        self._set_edges(*edges)
+
+    @metrics.timer('graph.adjacency')
+    def _set_edges(self, src, dst, weights):
+        '''
+        Stores the edges (src, dst, weights) as the CSR adjacency of the
+        graph and labels its connected components
+        '''
+        self.indptr, self.indices, self.weights = gu.to_csr(
+            len(self.names), src, dst, weights
+        )
+        self.components = gu.connected_components(len(self.names), src, dst)
+        self.n_components = int(self.components.max()) + 1 \
+            if len(self.components) else 0
+
+    def edges(self):
+        '''
+        Returns the arrays (src, dst, weights) of the edges, with src < dst
+        '''
+        rows = np.repeat(np.arange(len(self.names)), np.diff(self.indptr))
+        upper = rows < self.indices
+        return rows[upper], self.indices[upper], self.weights[upper]
+
+    @property
+    def G(self):
+        '''
+        networkx view of the graph, with the city names as nodes. It is
+        much larger than the graph itself, so it is only built on first use
+        '''
+        if getattr(self, '_G', None) is None:
+            self._G = self._build_nx()
+        return self._G
+
+    def _build_nx(self):
+        '''
+        Returns the networkx graph with the cities as nodes and the edges of
+        the CSR adjacency
+        '''
+        import networkx as nx
+
+        names = self.names.tolist()
+        G = nx.Graph()
+        G.add_nodes_from(names)
+        src, dst, weights = self.edges()
+        G.add_weighted_edges_from(zip(
+            [names[city] for city in src.tolist()],
+            [names[city] for city in dst.tolist()],
+            weights.tolist()
+        ))
+        return G
+
+    @metrics.timer('graph.derive')
+    def derive(self, max_dist, min_pop):
+        '''
+        Returns the graph (max_dist, min_pop) computed from this one, which
+        must have min_pop lower or equal and max_dist greater or equal.
+        Cities are filtered by population and edges by weight, without any
+        geometric search
+        '''
+        if min_pop < self.min_pop:
+            raise ValueError('Cannot derive a graph with more cities')
+        if max_dist > self.max_dist:
+            # It would need a search as expensive as building it
+            raise ValueError('Cannot derive a graph with longer edges')
+
+        keep = self.pops > min_pop
+        new_ids = np.cumsum(keep) - 1
+
+        graph = Graph.__new__(Graph)
+        graph.max_dist = max_dist
+        graph.min_pop = min_pop
+        graph.version = uuid.uuid4().hex
+        graph.names = self.names[keep]
+        graph.lats = np.array(self.lats[keep])
+        graph.lons = np.array(self.lons[keep])
+        graph.pops = np.array(self.pops[keep])
+        graph._coordinates = None
+        graph._populations = None
+
+        src, dst, weights = self.edges()
+        old = keep[src] & keep[dst] & (weights <= max_dist)
+        # Weights are float32, so the ones that round to about max_dist are
+        # measured again as they were when building
+        near = np.flatnonzero(old & (weights >= max_dist*(1 - c.HEURISTIC_SLACK)))
+        old[near] = gu.haversine_array(
+            self.lats[src[near]], self.lons[src[near]],
+            self.lats[dst[near]], self.lons[dst[near]]
+        ) <= max_dist
+        src, dst, weights = new_ids[src[old]], new_ids[dst[old]], weights[old]
+
+        graph._set_edges(src, dst, weights)
+        return graph
+
+    @metrics.timer('graph.save')
+    def save(self, path):
+        '''
+        Writes the graph to the snapshot directory path, replacing it
+        atomically if it already exists. Processes saving the same path at
+        once write to their own temporary directories, and the last one wins
+        '''
+        tmp_path = '{}.{}.tmp'.format(path.rstrip('/'), uuid.uuid4().hex)
+        os.makedirs(tmp_path)
+
+        arrays = {
+            'names': self.names.data,
+            'name_offsets': self.names.offsets,
+            'lats': self.lats,
+            'lons': self.lons,
+            'pops': self.pops,
+            'indptr': self.indptr,
+            'indices': self.indices,
+            'weights': self.weights,
+            'components': self.components
+        }
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_path, name + '.npy'), array)
+
+        meta = {
+            'format': c.SNAPSHOT_FORMAT,
+            'max_dist': self.max_dist,
+            'min_pop': self.min_pop,
+            'n_components': self.n_components,
+            'version': self.version,
+            'dataset': dataset.version()
+        }
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as meta_file:
+            json.dump(meta, meta_file)
+
+        if os.path.exists(path):
+            shutil.rmtree(path, ignore_errors=True)
+        try:
+            os.replace(tmp_path, path)
+        except OSError:
+            # Another process saved it after the rmtree; theirs is as good
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    @classmethod
+    @metrics.timer('graph.load')
+    def load(cls, path):
+        '''
+        Opens the snapshot directory path written by save. The arrays are
+        memory-mapped, so processes opening the same snapshot share them
+        '''
+        with open(os.path.join(path, 'meta.json')) as meta_file:
+            meta = json.load(meta_file)
+        if meta.get('format') != c.SNAPSHOT_FORMAT:
+            raise ValueError('Unsupported snapshot format in ' + path)
+
+        def array(name):
+            return np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+
+        graph = cls.__new__(cls)
+        graph.max_dist = meta['max_dist']
+        graph.min_pop = meta['min_pop']
+        graph.version = meta['version']
+        graph.names = gu.NameTable(array('names'), array('name_offsets'))
+        graph.lats = array('lats')
+        graph.lons = array('lons')
+        graph.pops = array('pops')
+        graph.indptr = array('indptr')
+        graph.indices = array('indices')
+        graph.weights = array('weights')
+        graph.components = array('components')
+        graph.n_components = meta['n_components']
+        graph._coordinates = None
+        graph._populations = None
+        return graph
+
+    @property
+    def coordinates(self):
+        '''
+        Dict from city name to its (latitude, longitude), built on first use
+        '''
+        if self._coordinates is None:
+            self._coordinates = dict(zip(
+                self.names,
+                zip(self.lats.tolist(), self.lons.tolist())
+            ))
+        return self._coordinates
+
+    @property
+    def populations(self):
+        '''
+        Dict from city name to its population, built on first use
+        '''
+        if self._populations is None:
+            self._populations = dict(zip(self.names, self.pops.tolist()))
+        return self._populations
+
+    def get_number_edges(self):
+        '''
+        Returns the number of edges in the graph
+        '''
+        # Each edge is stored in the adjacency of both its ends
+        return len(self.indices)//2
+
+    @property
+    def kdtree(self):
+        '''
+        Spatial index of the cities, built on first use
+        '''
+        if getattr(self, '_kdtree', None) is None:
+            self._kdtree = gu.KDTree(np.column_stack(
+                gu.spherical_to_cartesian((self.lats, self.lons))
+            ))
+        return self._kdtree
+
+    def cities_within(self, lat, lon, dist):
+        '''
+        Returns the ids of the cities at distance lower or equal than dist
+        from (lat, lon)
+        '''
+        point = gu.spherical_to_cartesian((lat, lon))
+        _, ids = self.kdtree.query_radius(point, gu.haversine_to_euclidean(dist))
+        near = gu.haversine_array(self.lats[ids], self.lons[ids], lat, lon) <= dist
+        return np.sort(ids[near])
+
+    def edges_between(self, ids):
+        '''
+        Returns the arrays (src, dst) of the edges with both ends in the
+        sorted array of city ids
+        '''
+        counts = self.indptr[ids + 1] - self.indptr[ids]
+        src = np.repeat(ids, counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        dst = np.asarray(self.indices[np.repeat(self.indptr[ids], counts) + offsets])
+
+        pos = np.minimum(np.searchsorted(ids, dst), len(ids) - 1)
+        inside = (ids[pos] == dst) & (src < dst)
+        return src[inside], dst[inside]
+
+    @property
+    def city_index(self):
+        '''
+        Search index of the city names, built on first use
+        '''
+        if getattr(self, '_city_index', None) is None:
+            from city_index import CityIndex
+            self._city_index = CityIndex(self.names.tolist())
+        return self._city_index
+
+    def get_city_id(self, name):
+        '''
+        Returns the id of the most similar city in G to name
+        '''
+        return self.city_index.lookup(name)
+
+    @property
+    def landmarks(self):
+        '''
+        ALT landmarks of the graph, computed on first use. None if they are
+        disabled
+        '''
+        if c.ROUTE_LANDMARKS <= 0:
+            return None
+        if getattr(self, '_landmarks', None) is None:
+            self._landmarks = routing.Landmarks(
+                self.indptr, self.indices, self.weights, c.ROUTE_LANDMARKS
+            )
+        return self._landmarks
+
+    def shortest_path(self, src, dst):
+        '''
+        Returns the list of city ids of the shortest route between the
+        cities src and dst, or None if they are not connected
+        '''
+        if self.components[src] != self.components[dst]:
+            return None
+        return routing.astar(
+            self.indptr, self.indices, self.weights, self.lats, self.lons,
+            src, dst, self.landmarks
+        )
+
+    def shortest_paths(self, src, dsts):
+        '''
+        Returns, for each of the city ids dsts, the (length, list of city
+        ids) of the shortest route from the city src, or None if they are
+        not connected. A single search serves all of them
+        '''
+        targets = [dst for dst in set(dsts) if self.components[dst] == self.components[src]]
+        if len(targets) == 1:
+            # A* explores less than Dijkstra when there is only one target
+            path = self.shortest_path(src, targets[0])
+            found = {targets[0]: (
+                routing.path_length(self.indptr, self.indices, self.weights, path), path
+            )}
+        else:
+            found = routing.dijkstra_paths(
+                self.indptr, self.indices, self.weights, src, targets
+            )
+        return [found.get(dst) for dst in dsts]
+
+
+def select_cities(cities, min_pop):
+    '''
+    Returns the rows of the cities DataFrame with more than min_pop
+    population and their "city, country; region" keys, in the order of
+    the DataFrame. Cities with the same key are a single node: the most
+    populated one (the last one if tied), so the node of a key does not
+    depend on min_pop and derived graphs match the built ones
+    '''
+    import pandas as pd
+
+    dataframe = cities[cities['Population'] > min_pop]
+    keys = (
+        dataframe['AccentCity'].astype(str) + ', ' +
+        dataframe['Country'].astype(str) + '; ' +
+        dataframe['Region'].astype(str)
+    ).to_numpy(dtype=object)
+
+    order = np.argsort(dataframe['Population'].to_numpy(), kind='stable')
+    unique = order[~pd.Series(keys[order]).duplicated(keep='last').to_numpy()]
+    unique.sort()
+    return dataframe.iloc[unique], keys[unique]
+
+
+def plot_edges(lats0, lons0, lats1, lons1):
+    '''
+    Returns the plot of the edges from (lats0, lons0) to (lats1, lons1)
+    '''
+    import render
+
+    if len(lats0) > c.LOD_MIN_EDGES:
+        with metrics.timer('plotgraph.simplify'):
+            lats0, lons0, lats1, lons1 = render.simplify_segments(
+                lats0, lons0, lats1, lons1
+            )
+
+    mapa = render.ArrayMap()
+    mapa.add_segments(lats0, lons0, lats1, lons1, 'blue', 3)
+
+    return render.to_png(mapa)
+
+
+def plot_cities(lats, lons, pops):
+    '''
+    Returns the plot of the cities with circles sized by their population
+    '''
+    import render
+
+    if len(lats) > c.LOD_MIN_CIRCLES:
+        with metrics.timer('plotpop.merge'):
+            lats, lons, pops = render.merge_circles(lats, lons, pops)
+
+    mapa = render.ArrayMap()
+    mapa.add_circles(lats, lons, pops*c.CIRCLE_SCALE/pops.max(), 'red')
+
+    return render.to_png(mapa)
+
+
+def plot_path(lats, lons):
+    '''
+    Returns the plot of the route through the cities (lats, lons)
+    '''
+    import render
+
+    mapa = render.ArrayMap()
+    mapa.add_segments(lats[:-1], lons[:-1], lats[1:], lons[1:], 'blue', 3)
+    mapa.add_circles(lats, lons, 4, 'red')
+
+    return render.to_png(mapa)
+
+
+# Registry of the graphs shared by all the chats, in LRU order
+_graphs = OrderedDict()
+_graphs_lock = threading.Lock()
+_build_locks = dict()
+
+
+def _graph_size(graph):
+    '''
+    Returns the number of elements (nodes and edges) stored by graph
+    '''
+    if graph.sharded:
+        # Only its loaded shards, which it bounds itself
+        return graph.loaded_elements
+    return graph.get_number_nodes() + graph.get_number_edges()
+
+
+def _evict():
+    '''
+    Drops the least recently used graphs until the registry fits in its
+    budget. The most recent graph is always kept
+    '''
+    total = sum(_graph_size(graph) for graph in _graphs.values())
+    while len(_graphs) > 1 and (
+            len(_graphs) > c.GRAPH_CACHE_SIZE or
+            total > c.GRAPH_CACHE_ELEMENTS):
+        _, graph = _graphs.popitem(last=False)
+        total -= _graph_size(graph)
+
+
+def snapshot_path(max_dist, min_pop):
+    '''
+    Returns the path of the snapshot of the graph (max_dist, min_pop)
+    '''
+    return os.path.join(c.SNAPSHOT_DIR, '{}_{}'.format(max_dist, min_pop))
+
+
+_snapshots = None
+_snapshots_lock = threading.Lock()
+
+
+def get_snapshot_cache():
+    '''
+    Returns the size-bounded directory of the snapshots, which evicts the
+    ones of the least recently opened graphs
+    '''
+    global _snapshots
+    with _snapshots_lock:
+        if _snapshots is None:
+            _snapshots = disk_cache.DirectoryCache(c.SNAPSHOT_DIR, c.SNAPSHOT_CACHE_BYTES, '')
+        return _snapshots
+
+
+def _find_base(max_dist, min_pop):
+    '''
+    Returns the shared graph from which (max_dist, min_pop) is cheapest
+    to derive: one with all its cities and all its edges. Returns None if
+    there is none, as deriving longer edges costs as much as building
+    '''
+    with _graphs_lock:
+        candidates = [
+            graph for graph in _graphs.values()
+            if graph.min_pop <= min_pop and graph.max_dist >= max_dist and
+            not graph.sharded
+        ]
+    if not candidates:
+        return None
+
+    # Prefer the fewest edges to filter: the shortest distance, then the
+    # fewest cities
+    return min(candidates, key=lambda graph: (graph.max_dist, -graph.min_pop))
+
+
+def _load_or_build(max_dist, min_pop):
+    '''
+    Opens the snapshot of the graph if it is up to date with the dataset,
+    otherwise derives it from a shared graph or builds it, and saves its
+    snapshot (evicting the least recently used ones). Graphs with an up to date sharded snapshot are opened from
+    it instead
+    '''
+    import shards
+
+    sharded = shards.open_current(max_dist, min_pop)
+    if sharded is not None:
+        return sharded
+
+    path = snapshot_path(max_dist, min_pop)
+    try:
+        with open(os.path.join(path, 'meta.json')) as meta_file:
+            meta = json.load(meta_file)
+        version = dataset.version()
+        if version and meta.get('dataset') == version:
+            graph = Graph.load(path)
+            get_snapshot_cache().touch(path)
+            return graph
+    except (OSError, ValueError):
+        pass
+
+    base = _find_base(max_dist, min_pop)
+    if base is not None:
+        graph = base.derive(max_dist, min_pop)
+    else:
+        graph = Graph(max_dist, min_pop, workers=c.BUILD_WORKERS)
+    try:
+        if not os.path.exists(c.SNAPSHOT_DIR):
+            os.makedirs(c.SNAPSHOT_DIR)
+        graph.save(path)
+        snapshots = get_snapshot_cache()
+        snapshots.add(path, snapshots.size(path))
+    except OSError:
+        logging.exception('Could not save the snapshot %s', path)
+    return graph
+
+
+def get_graph(max_dist=c.MAX_DISTANCE, min_pop=c.MIN_POPULATION):
+    '''
+    Returns the graph with parameters (max_dist, min_pop). Graphs are
+    built (or opened from their snapshot) only once and shared, so they
+    must not be modified
+    '''
+    key = (max_dist, min_pop)
+    with _graphs_lock:
+        if key in _graphs:
+            _graphs.move_to_end(key)
+            return _graphs[key]
+        build_lock = _build_locks.setdefault(key, threading.Lock())
+
+    # Only one thread builds each graph; the others wait for it
+    with build_lock:
+        with _graphs_lock:
+            if key in _graphs:
+                _graphs.move_to_end(key)
+                return _graphs[key]
+
+        graph = _load_or_build(max_dist, min_pop)
+
+        with _graphs_lock:
+            _graphs[key] = graph
+            _evict()
+            _build_locks.pop(key, None)
+        return graph
@@ -2,22 +2,23 @@
 Utilities to build the graph
 '''
 import math
+from concurrent.futures import ProcessPoolExecutor
 
-import networkx as nx
-from haversine import haversine
+import numpy as np
 
 import constants as c
 
 
 def spherical_to_cartesian(coords):
     '''
-    Converts spherical coordinates to cartesian coordinates
+    Converts spherical coordinates to cartesian coordinates. Works both
+    with a single (lat, lon) pair and with a pair of arrays
     '''
-    rad_lat, rad_lon = math.radians(coords[0]), math.radians(coords[1])
+    rad_lat, rad_lon = np.radians(coords[0]), np.radians(coords[1])
 
-    x = c.EARTH_RADIUS*math.cos(rad_lat)*math.cos(rad_lon)
-    y = c.EARTH_RADIUS*math.cos(rad_lat)*math.sin(rad_lon)
-    z = c.EARTH_RADIUS*math.sin(rad_lat)
+    x = c.EARTH_RADIUS*np.cos(rad_lat)*np.cos(rad_lon)
+    y = c.EARTH_RADIUS*np.cos(rad_lat)*np.sin(rad_lon)
+    z = c.EARTH_RADIUS*np.sin(rad_lat)
     return x, y, z
 
 
@@ -30,71 +31,340 @@ def haversine_to_euclidean(dist):
     return math.sqrt((1-math.cos(gamma))*2*(R**2))
 
 
-def build_kdtree(points, depth=0):
+def haversine_array(lats0, lons0, lats1, lons1):
     '''
-    Builds a 3-dimensional kdtree to store the cities
+    Returns the haversine distances between the points (lats0, lons0) and
+    (lats1, lons1), element by element
     '''
-    n = len(points)
+    lats0, lons0 = np.radians(lats0), np.radians(lons0)
+    lats1, lons1 = np.radians(lats1), np.radians(lons1)
 
-    if n <= 0:
-        return None
+    a = np.sin((lats1 - lats0)/2)**2 + \
+        np.cos(lats0)*np.cos(lats1)*np.sin((lons1 - lons0)/2)**2
+    return 2*c.EARTH_RADIUS*np.arcsin(np.sqrt(np.minimum(a, 1)))
 
-    axis = depth % 3
 
-    sorted_points = sorted(points, key=lambda point: point['coords'][axis])
+class KDTree:
+    '''
+    3-dimensional kdtree stored in flat arrays. Node k has children 2k+1
+    and 2k+2 and covers the points perm[start[k]:end[k]]; all the leaves
+    are in the last level and hold at most leaf_size points
+    '''
+
+    def __init__(self, points, leaf_size=c.KDTREE_LEAF_SIZE):
+        self.points = np.asarray(points, dtype=float).reshape(-1, 3)
+        n = len(self.points)
+
+        self.depth = 0
+        while n > leaf_size * 2**self.depth:
+            self.depth += 1
+        n_nodes = 2**(self.depth + 1) - 1
+        self.first_leaf = 2**self.depth - 1
+
+        self.perm = np.arange(n)
+        self.start = np.zeros(n_nodes, dtype=np.int64)
+        self.end = np.zeros(n_nodes, dtype=np.int64)
+        self.lo = np.full((n_nodes, 3), np.inf)
+        self.hi = np.full((n_nodes, 3), -np.inf)
+        self.end[0] = n
+
+        # Nodes are visited in level order, so parents come before children
+        for k in range(n_nodes):
+            s, e = self.start[k], self.end[k]
+            if e > s:
+                box = self.points[self.perm[s:e]]
+                self.lo[k] = box.min(axis=0)
+                self.hi[k] = box.max(axis=0)
+            if k >= self.first_leaf:
+                continue
+
+            mid = (s + e)//2
+            if e - s > 1:
+                axis = np.argmax(self.hi[k] - self.lo[k])
+                keys = self.points[self.perm[s:e], axis]
+                order = np.argpartition(keys, mid - s)
+                self.perm[s:e] = self.perm[s:e][order]
+            self.start[2*k + 1], self.end[2*k + 1] = s, mid
+            self.start[2*k + 2], self.end[2*k + 2] = mid, e
+
+    def _box_distance(self, queries, nodes):
+        '''
+        Returns the euclidean distance from each query to the bounding box
+        of the corresponding node
+        '''
+        below = np.maximum(self.lo[nodes] - queries, 0)
+        above = np.maximum(queries - self.hi[nodes], 0)
+        return np.sqrt(((below + above)**2).sum(axis=1))
+
+    def query_radius(self, queries, radius):
+        '''
+        Returns two arrays (query_ids, point_ids) with all the pairs of a
+        query and a point at euclidean distance at most radius
+        '''
+        queries = np.asarray(queries, dtype=float).reshape(-1, 3)
+        query_ids = np.arange(len(queries))
+        nodes = np.zeros(len(queries), dtype=np.int64)
+
+        # Descend level by level, keeping the (query, node) pairs whose
+        # bounding box is within reach
+        for level in range(self.depth + 1):
+            near = self._box_distance(queries[query_ids], nodes) <= radius
+            query_ids, nodes = query_ids[near], nodes[near]
+            if level < self.depth:
+                query_ids = np.repeat(query_ids, 2)
+                nodes = np.repeat(2*nodes + 1, 2)
+                nodes[1::2] += 1
+
+        # Expand each (query, leaf) pair to the points in the leaf
+        counts = self.end[nodes] - self.start[nodes]
+        query_ids = np.repeat(query_ids, counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        point_ids = self.perm[np.repeat(self.start[nodes], counts) + offsets]
+
+        diff = self.points[point_ids] - queries[query_ids]
+        near = (diff**2).sum(axis=1) <= radius**2
+        return query_ids[near], point_ids[near]
 
-    return {
-        'point': sorted_points[int(n/2)],
-        'left': build_kdtree(sorted_points[:int(n/2)], depth + 1),
-        'right': build_kdtree(sorted_points[int(n/2) + 1:], depth + 1)
-    }
 
+# Offsets to the neighbouring grid cells that come after a cell, so that
+# each pair of neighbouring cells is visited only once
+_HALF_OFFSETS = [
+    (dx, dy, dz)
+    for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dz in (-1, 0, 1)
+    if (dx, dy, dz) > (0, 0, 0)
+]
 
-def search_neighbours(kdtree, dist, edist, point_cartesian, point_spherical, coordinates, depth=0):
+
+def _cell_pairs(starts, counts, cells_a, cells_b):
+    '''
+    Yields the positions (in cell order) of all the pairs of points of
+    cells_a[k] and cells_b[k], in chunks of bounded size
+    '''
+    totals = counts[cells_a]*counts[cells_b]
+    bounds = np.cumsum(totals)
+    first = 0
+    while first < len(totals):
+        base = bounds[first] - totals[first]
+        last = np.searchsorted(bounds, base + c.JOIN_CHUNK, side='right')
+        last = max(last, first + 1)
+        chunk = slice(first, last)
+        first = last
+
+        a, b, total = cells_a[chunk], cells_b[chunk], totals[chunk]
+        pair_cell = np.repeat(np.arange(len(a)), total)
+        within = np.arange(total.sum()) - \
+            np.repeat(np.cumsum(total) - total, total)
+        width = counts[b][pair_cell]
+        yield (
+            starts[a][pair_cell] + within//width,
+            starts[b][pair_cell] + within % width
+        )
+
+
+def radius_join(points, edist):
     '''
-    Returns a set with all the points nearest
+    Returns two arrays (src, dst) with all the pairs of points at euclidean
+    distance at most edist, with src < dst. Points are bucketed in a grid
+    of cells of side edist, so only neighbouring cells are compared
     '''
-    result = set()
+    points = np.asarray(points, dtype=float).reshape(-1, 3)
+    if len(points) == 0 or edist <= 0:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
 
-    axis = depth % 3
+    # Integer cell of each point, with a margin of one cell on each side
+    cells = np.floor(points/edist).astype(np.int64)
+    cells -= cells.min(axis=0) - 1
+    dims = cells.max(axis=0) + 2
+    keys = (cells[:, 0]*dims[1] + cells[:, 1])*dims[2] + cells[:, 2]
 
-    if haversine(coordinates[kdtree['point']['city']], point_spherical) <= dist:
-        result.add(kdtree['point']['city'])
+    order = np.argsort(keys, kind='stable')
+    sorted_points = points[order]
+    uniq, starts, counts = np.unique(
+        keys[order], return_index=True, return_counts=True
+    )
 
-    if not kdtree['left'] is None:
-        if kdtree['point']['coords'][axis] > point_cartesian[axis] - edist:
-            result = result.union(search_neighbours(kdtree['left'], dist, edist, point_cartesian, point_spherical, coordinates, depth + 1))
+    src, dst = [], []
+    for offset in [(0, 0, 0)] + _HALF_OFFSETS:
+        if offset == (0, 0, 0):
+            cells_a = cells_b = np.arange(len(uniq))
+        else:
+            dx, dy, dz = offset
+            target = uniq + (dx*dims[1] + dy)*dims[2] + dz
+            pos = np.minimum(np.searchsorted(uniq, target), len(uniq) - 1)
+            cells_a = np.nonzero(uniq[pos] == target)[0]
+            cells_b = pos[cells_a]
 
-    if not kdtree['right'] is None:
-        if kdtree['point']['coords'][axis] < point_cartesian[axis] + edist:
-            result = result.union(search_neighbours(kdtree['right'], dist, edist, point_cartesian, point_spherical, coordinates, depth + 1))
+        for a, b in _cell_pairs(starts, counts, cells_a, cells_b):
+            if offset == (0, 0, 0):
+                keep = a < b
+                a, b = a[keep], b[keep]
+            diff = sorted_points[a] - sorted_points[b]
+            near = (diff**2).sum(axis=1) <= edist**2
+            a, b = order[a[near]], order[b[near]]
+            src.append(np.minimum(a, b))
+            dst.append(np.maximum(a, b))
 
-    return result
+    return np.concatenate(src), np.concatenate(dst)
 
 
-def build_graph(coordinates, dist):
+def _join_band(points, n_owned, edist):
     '''
-    Returns a geometric graph of all cities in coordinates
+    Runs radius_join on a band whose first n_owned points are its own
+    and the rest are the halo shared with the previous band. Pairs of two
+    halo points belong to the previous band and are dropped
     '''
-    cartesian_points = [{'city': k, 'coords': spherical_to_cartesian(v)} for k, v in coordinates.items()]
+    src, dst = radius_join(points, edist)
+    keep = src < n_owned
+    return src[keep], dst[keep]
+
+
+def parallel_radius_join(points, edist, workers):
+    '''
+    Same as radius_join, but splitting the points in latitude bands (bands
+    of the z coordinate) that are joined in a pool of worker processes.
+    Each band also gets the points of the previous band that are closer
+    than edist to it, so pairs across bands are found exactly once
+    '''
+    points = np.asarray(points, dtype=float).reshape(-1, 3)
+    order = np.argsort(points[:, 2], kind='stable')
+    z = points[order, 2]
+    bounds = np.linspace(0, len(points), workers + 1).astype(np.int64)
+
+    bands = []
+    for first, last in zip(bounds[:-1], bounds[1:]):
+        if first == last:
+            continue
+        halo = np.searchsorted(z, z[first] - edist, side='left')
+        ids = np.concatenate((order[first:last], order[halo:first]))
+        bands.append((ids, last - first))
+
+    src, dst = [], []
+    with ProcessPoolExecutor(workers) as executor:
+        results = executor.map(
+            _join_band,
+            [points[ids] for ids, _ in bands],
+            [n_owned for _, n_owned in bands],
+            [edist]*len(bands)
+        )
+        for (ids, _), (a, b) in zip(bands, results):
+            a, b = ids[a], ids[b]
+            src.append(np.minimum(a, b))
+            dst.append(np.maximum(a, b))
+
+    if not src:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    return np.concatenate(src), np.concatenate(dst)
+
+
+def build_edges(lats, lons, dist, workers=1):
+    '''
+    Returns the edges (src, dst, weights) of the geometric graph of the
+    cities (lats, lons), with src < dst and haversine weights. With more
+    than one worker, large inputs are joined in parallel
+    '''
+    points = np.column_stack(spherical_to_cartesian((lats, lons)))
+    edist = haversine_to_euclidean(dist)
+    if workers > 1 and len(points) >= c.PARALLEL_MIN_CITIES:
+        src, dst = parallel_radius_join(points, edist, workers)
+    else:
+        src, dst = radius_join(points, edist)
+
+    weights = haversine_array(lats[src], lons[src], lats[dst], lons[dst])
+    near = weights <= dist
+    return src[near], dst[near], weights[near]
+
+
+def to_csr(n, src, dst, weights):
+    '''
+    Returns the symmetric CSR adjacency (indptr, indices, weights) of the
+    n nodes joined by the undirected edges (src, dst)
+    '''
+    rows = np.concatenate((src, dst))
+    cols = np.concatenate((dst, src))
+    both = np.concatenate((weights, weights))
+
+    order = np.lexsort((cols, rows))
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n), out=indptr[1:])
+    return (
+        indptr,
+        cols[order].astype(np.int32),
+        both[order].astype(np.float32)
+    )
+
+
+def connected_components(n, src, dst):
+    '''
+    Returns the array with the connected component (from 0 to the number
+    of components - 1) of each of the n nodes joined by the edges
+    (src, dst). It is a union-find over all the edges at once: roots are
+    hooked to the smallest root they are joined to, and paths are then
+    compressed by pointer jumping, until no edge joins two roots
+    '''
+    labels = np.arange(n)
+    while True:
+        a, b = labels[src], labels[dst]
+        joined = a != b
+        if not joined.any():
+            break
+        np.minimum.at(labels, np.maximum(a, b)[joined], np.minimum(a, b)[joined])
+        while True:
+            jumped = labels[labels]
+            if np.array_equal(jumped, labels):
+                break
+            labels = jumped
+
+    return np.unique(labels, return_inverse=True)[1].reshape(-1).astype(np.int32)
+
+
+class NameTable:
+    '''
+    Read-only list of strings stored as a single UTF-8 buffer plus the
+    offset of each string in it, much smaller than Python strings
+    '''
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    @classmethod
+    def from_strings(cls, strings):
+        '''
+        Returns the table of the iterable of strings
+        '''
+        encoded = [string.encode('utf-8') for string in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(string) for string in encoded], out=offsets[1:])
+        return cls(np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
 
-    kdtree = build_kdtree(cartesian_points)
+    def __getitem__(self, key):
+        '''
+        Returns the string at position key, or the table of the strings
+        selected by key if it is a slice, a mask or an array of positions
+        '''
+        if isinstance(key, (int, np.integer)):
+            key = range(len(self))[key]
+            return bytes(self.data[self.offsets[key]:self.offsets[key + 1]]).decode('utf-8')
 
-    G = nx.Graph()
-    G.add_nodes_from(coordinates.keys())
+        ids = np.arange(len(self))[key]
+        starts = self.offsets[ids]
+        lengths = self.offsets[ids + 1] - starts
+        offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        positions = np.arange(offsets[-1]) - np.repeat(offsets[:-1] - starts, lengths)
+        return NameTable(np.asarray(self.data)[positions], offsets)
 
-    for node in G.nodes:
-        point_spherical = coordinates[node]
-        point_cartesian = spherical_to_cartesian(point_spherical)
-        for neighbour in search_neighbours(
-            kdtree,
-            dist,
-            haversine_to_euclidean(dist),
-            point_cartesian,
-            point_spherical,
-            coordinates
-        ):
-            if node != neighbour:
-                G.add_edge(node, neighbour, weigth=haversine(coordinates[neighbour], point_spherical))
+    def __iter__(self):
+        data = bytes(self.data)
+        offsets = self.offsets.tolist()
+        for first, last in zip(offsets[:-1], offsets[1:]):
+            yield data[first:last].decode('utf-8')
 
-    return G
+    def tolist(self):
+        '''
+        Returns the strings as a list
+        '''
+        return list(self)
@@ -0,0 +1,209 @@
+'''
+Timings of the bot commands and of the stages of graph building, routing
+and rendering, plus an opt-in profiler for slow requests
+'''
+import cProfile
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import constants as c
+
+
+class Histogram:
+    '''
+    Timings of one command or stage: the count and total of all of them,
+    and the last METRICS_SAMPLES ones for the percentiles
+    '''
+
+    def __init__(self, size=c.METRICS_SAMPLES):
+        self.samples = deque(maxlen=size)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, seconds):
+        '''
+        Adds a timing, in seconds
+        '''
+        self.samples.append(seconds)
+        self.count += 1
+        self.total += seconds
+
+    def summary(self):
+        '''
+        Returns the count, the mean and the p50, p99 and max of the recent
+        timings, in seconds
+        '''
+        recent = sorted(self.samples)
+
+        def percentile(q):
+            return recent[min(int(q/100*len(recent)), len(recent) - 1)]
+
+        return {
+            'count': self.count,
+            'mean': self.total/self.count,
+            'p50': percentile(50),
+            'p99': percentile(99),
+            'max': recent[-1]
+        }
+
+
+_histograms = dict()
+_lock = threading.Lock()
+# Timings taken by the current thread, if it is recording them
+_local = threading.local()
+
+
+def observe(name, seconds):
+    '''
+    Adds a timing of name, in seconds
+    '''
+    with _lock:
+        if name not in _histograms:
+            _histograms[name] = Histogram()
+        _histograms[name].add(seconds)
+
+    recorded = getattr(_local, 'recorded', None)
+    if recorded is not None:
+        recorded.append((name, seconds))
+
+
+@contextmanager
+def timer(name):
+    '''
+    Times the block (or the decorated function) as name
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+@contextmanager
+def recording():
+    '''
+    Collects in a list the timings taken by this thread inside the block.
+    Worker processes send them back with the results of their jobs
+    '''
+    _local.recorded = []
+    try:
+        yield _local.recorded
+    finally:
+        _local.recorded = None
+
+
+def merge(timings):
+    '''
+    Adds the list of (name, seconds) collected by recording
+    '''
+    for name, seconds in timings:
+        observe(name, seconds)
+
+
+def is_admin(chat_id):
+    '''
+    Tells if chat_id is in the environment variable ADMINS_ENV
+    '''
+    admins = os.environ.get(c.ADMINS_ENV, '')
+    return str(chat_id) in {admin.strip() for admin in admins.split(',')}
+
+
+def summary():
+    '''
+    Returns the summary of the timings of each command and stage
+    '''
+    with _lock:
+        return {name: _histograms[name].summary() for name in sorted(_histograms)}
+
+
+def report():
+    '''
+    Returns the summary as a text table, in milliseconds
+    '''
+    lines = ['{:<22}{:>7}{:>9}{:>9}{:>9}'.format('ms', 'count', 'p50', 'p99', 'max')]
+    for name, stats in summary().items():
+        lines.append('{:<22}{:>7}{:>9.1f}{:>9.1f}{:>9.1f}'.format(
+            name, stats['count'], stats['p50']*1000, stats['p99']*1000, stats['max']*1000
+        ))
+    return '\n'.join(lines)
+
+
+@contextmanager
+def profiled(name):
+    '''
+    If the environment variable PROFILE_ENV is set to a number of seconds,
+    profiles a fraction PROFILE_RATE of the runs of the block and saves to
+    PROFILE_DIR the profiles of the ones that take longer than that
+    '''
+    threshold = os.environ.get(c.PROFILE_ENV)
+    profiler = None
+    if threshold and random.random() < c.PROFILE_RATE:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is running in this thread
+            profiler = None
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            elapsed = time.perf_counter() - start
+            if elapsed >= float(threshold):
+                os.makedirs(c.PROFILE_DIR, exist_ok=True)
+                path = os.path.join(
+                    c.PROFILE_DIR, '{}-{}.prof'.format(name, int(time.time()*1000))
+                )
+                profiler.dump_stats(path)
+                logging.info('Profile of %s (%.3f s) saved to %s', name, elapsed, path)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    '''
+    Serves the summary as JSON at /metrics
+    '''
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = json.dumps(summary()).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(port):
+    '''
+    Serves the summary at http://localhost:port/metrics from a background
+    thread, and returns the server
+    '''
+    server = ThreadingHTTPServer(('localhost', port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def serve_from_env():
+    '''
+    Starts serve on the port in the environment variable METRICS_PORT_ENV,
+    if set
+    '''
+    port = os.environ.get(c.METRICS_PORT_ENV)
+    if port:
+        serve(int(port))
+        logging.info('Metrics at http://localhost:%s/metrics', port)
@@ -0,0 +1,629 @@
+'''
+Map rendering with a local cache of map tiles and of rendered images
+'''
+import argparse
+import asyncio
+import math
+import os
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import aiohttp
+import numpy as np
+import requests
+from PIL import Image, ImageColor
+from staticmap import StaticMap
+
+import constants as c
+import disk_cache
+import metrics
+
+
+_TILE_RE = re.compile(r'/(\d+)/(\d+)/(\d+)\.png')
+
+
+def tile_dir():
+    '''
+    Returns the directory of the tile cache
+    '''
+    return os.environ.get(c.TILE_DIR_ENV) or c.TILE_DIR
+
+
+def offline():
+    '''
+    Returns True if tiles must never be downloaded
+    '''
+    return bool(os.environ.get(c.TILE_OFFLINE_ENV))
+
+
+class TileCache:
+    '''
+    Size-bounded directory of map tiles stored as {z}/{x}/{y}.png, evicting
+    the least recently used ones. The bound holds for the directory, which
+    every process of the bot shares
+    '''
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.blank = None
+        self.disk = disk_cache.DiskCache(path, max_bytes, '.png')
+
+    def tile_path(self, z, x, y):
+        '''
+        Returns the path of the tile (z, x, y)
+        '''
+        return os.path.join(self.path, str(z), str(x), '{}.png'.format(y))
+
+    def read(self, tile_path):
+        '''
+        Returns the content of the cached tile, or None if it is missing
+        '''
+        try:
+            with open(tile_path, 'rb') as tile_file:
+                content = tile_file.read()
+        except OSError:
+            return None
+        self.disk.touch(tile_path)
+        return content
+
+    def write(self, tile_path, content):
+        '''
+        Stores a tile, evicting the least recently used ones if needed
+        '''
+        os.makedirs(os.path.dirname(tile_path), exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(tile_path, threading.get_ident())
+        with open(tmp_path, 'wb') as tile_file:
+            tile_file.write(content)
+        os.replace(tmp_path, tile_path)
+        self.disk.add(tile_path, len(content))
+
+    def blank_tile(self):
+        '''
+        Returns an empty tile, used for the missing tiles when offline
+        '''
+        if self.blank is None:
+            bio = BytesIO()
+            Image.new('RGB', (c.TILE_SIZE, c.TILE_SIZE), c.TILE_BLANK_COLOR).save(bio, 'PNG')
+            self.blank = bio.getvalue()
+        return self.blank
+
+    def get(self, url, **kwargs):
+        '''
+        Returns the status code and content of the tile at url, from the
+        cache if possible
+        '''
+        match = _TILE_RE.search(url)
+        if not match:
+            res = requests.get(url, **kwargs)
+            return res.status_code, res.content
+
+        tile_path = self.tile_path(*match.groups())
+        content = self.read(tile_path)
+        if content is not None:
+            return 200, content
+        if offline():
+            return 200, self.blank_tile()
+
+        with metrics.timer('tiles.download'):
+            res = requests.get(url, **kwargs)
+        if res.status_code == 200:
+            self.write(tile_path, res.content)
+        return res.status_code, res.content
+
+
+_tiles = None
+_tiles_lock = threading.Lock()
+
+
+def get_tile_cache():
+    '''
+    Returns the tile cache shared by the whole process
+    '''
+    global _tiles
+    with _tiles_lock:
+        if _tiles is None:
+            _tiles = TileCache(tile_dir(), c.TILE_CACHE_BYTES)
+        return _tiles
+
+
+class CachedStaticMap(StaticMap):
+    '''
+    StaticMap that gets its tiles through the tile cache
+    '''
+
+    def __init__(self, width=c.MAP_SIZE, height=c.MAP_SIZE, **kwargs):
+        kwargs.setdefault('url_template', c.TILE_URL)
+        kwargs.setdefault('tile_size', c.TILE_SIZE)
+        super().__init__(width, height, **kwargs)
+
+    def _tile_urls(self):
+        '''
+        Returns the (x, y, url) of the tiles under the map, as StaticMap
+        numbers them
+        '''
+        x_min = int(math.floor(self.x_center - 0.5*self.width/self.tile_size))
+        y_min = int(math.floor(self.y_center - 0.5*self.height/self.tile_size))
+        x_max = int(math.ceil(self.x_center + 0.5*self.width/self.tile_size))
+        y_max = int(math.ceil(self.y_center + 0.5*self.height/self.tile_size))
+
+        tiles = []
+        max_tile = 2**self.zoom
+        for x in range(x_min, x_max):
+            for y in range(y_min, y_max):
+                # x and y may have crossed the date line
+                tile_x, tile_y = x % max_tile, y % max_tile
+                if getattr(self, 'reverse_y', False):
+                    tile_y = max_tile - 1 - tile_y
+                tiles.append((x, y, self.url_template.format(z=self.zoom, x=tile_x, y=tile_y)))
+        return tiles
+
+    def _draw_base_layer(self, image):
+        '''
+        Pastes the tiles under the map, got through the tile cache. Replaces
+        the one of StaticMap, as only some of its versions fetch the tiles
+        with an overridable method
+        '''
+        cache = get_tile_cache()
+
+        def fetch(url):
+            try:
+                return cache.get(url, timeout=c.TILE_TIMEOUT, headers={'User-Agent': 'StaticMap'})
+            except requests.RequestException:
+                return None, None
+
+        tiles = self._tile_urls()
+        with ThreadPoolExecutor(c.TILE_THREADS) as pool:
+            for _ in range(c.TILE_RETRIES):
+                failed = []
+                for tile, (status, content) in zip(tiles, pool.map(fetch, [tile[2] for tile in tiles])):
+                    if status != 200:
+                        failed.append(tile)
+                        continue
+                    x, y, _ = tile
+                    tile_image = Image.open(BytesIO(content)).convert('RGBA')
+                    box = [self._x_to_px(x), self._y_to_px(y), self._x_to_px(x + 1), self._y_to_px(y + 1)]
+                    image.paste(tile_image, box, tile_image)
+                tiles = failed
+                if not tiles:
+                    return
+        raise RuntimeError('could not download {} tiles: {}'.format(len(tiles), tiles))
+
+
+def _chunks(counts, size):
+    '''
+    Yields slices of consecutive items whose counts add up to about size
+    '''
+    ends = np.cumsum(counts)
+    first = 0
+    while first < len(counts):
+        done = ends[first - 1] if first else 0
+        last = max(int(np.searchsorted(ends, done + size, 'right')), first + 1)
+        yield slice(first, last)
+        first = last
+
+
+def _repeat_ranges(counts):
+    '''
+    Returns, for the ranges of each of the counts, the index of the range
+    and the position inside it of every element
+    '''
+    owner = np.repeat(np.arange(len(counts)), counts)
+    starts = np.cumsum(counts) - counts
+    return owner, np.arange(len(owner)) - starts[owner]
+
+
+def _fill_disks(spans, xs, ys, radii):
+    '''
+    Adds to the difference array spans (of shape (height, width + 1)) the
+    pixel spans of the disks of the given centers and radii
+    '''
+    height, width = spans.shape[0], spans.shape[1] - 1
+    reach = np.floor(radii).astype(np.int64)
+    for part in _chunks(2*reach + 1, c.RASTER_CHUNK):
+        owner, row = _repeat_ranges(2*reach[part] + 1)
+        dy = row - reach[part][owner]
+        r = radii[part][owner]
+        half = np.floor(np.sqrt(np.maximum(r*r - dy*dy, 0))).astype(np.int64)
+        y = ys[part][owner] + dy
+        x0 = np.maximum(xs[part][owner] - half, 0)
+        x1 = np.minimum(xs[part][owner] + half, width - 1)
+        keep = (y >= 0) & (y < height) & (x0 <= x1)
+        y, x0, x1 = y[keep], x0[keep], x1[keep]
+
+        flat = spans.reshape(-1)
+        flat += np.bincount(y*(width + 1) + x0, minlength=flat.size).astype(flat.dtype)
+        flat -= np.bincount(y*(width + 1) + x1 + 1, minlength=flat.size).astype(flat.dtype)
+
+
+def _line_centers(x0, y0, x1, y1, width, height):
+    '''
+    Returns the distinct pixels (xs, ys) of a width x height canvas on the
+    segments between the given pixel ends, one per step along their
+    longest axis
+    '''
+    steps = np.maximum(np.abs(x1 - x0), np.abs(y1 - y0))
+    on_line = np.zeros((height, width), bool)
+    for part in _chunks(steps + 1, c.RASTER_CHUNK):
+        owner, k = _repeat_ranges(steps[part] + 1)
+        t = k/np.maximum(steps[part][owner], 1)
+        xs = np.rint(x0[part][owner] + t*(x1 - x0)[part][owner]).astype(np.int64)
+        ys = np.rint(y0[part][owner] + t*(y1 - y0)[part][owner]).astype(np.int64)
+        keep = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+        on_line[ys[keep], xs[keep]] = True
+    ys, xs = np.nonzero(on_line)
+    return xs, ys
+
+
+class ArrayMap(CachedStaticMap):
+    '''
+    CachedStaticMap for many features of the same style at once. Segments
+    and circles are given as coordinate arrays, projected in one pass and
+    drawn with a single fill per layer instead of one Pillow call per
+    Line or CircleMarker. As in StaticMap, the features are drawn at twice
+    the size and scaled down to smooth their borders
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Layers in drawing order: (color, lats, lons, radii, lats1, lons1).
+        # The last two are None for circles
+        self.layers = []
+
+    def add_segments(self, lats0, lons0, lats1, lons1, color, width):
+        '''
+        Adds the segments from (lats0, lons0) to (lats1, lons1), of width
+        pixels like a staticmap Line
+        '''
+        if len(lats0):
+            self.layers.append((
+                color, np.asarray(lats0, float), np.asarray(lons0, float),
+                np.full(len(lats0), float(width)),
+                np.asarray(lats1, float), np.asarray(lons1, float)
+            ))
+
+    def add_circles(self, lats, lons, radii, color):
+        '''
+        Adds circles at (lats, lons) with radii like staticmap CircleMarkers
+        '''
+        if len(lats):
+            self.layers.append((
+                color, np.asarray(lats, float), np.asarray(lons, float),
+                np.broadcast_to(np.asarray(radii, float), len(lats)), None, None
+            ))
+
+    def determine_extent(self, zoom=None):
+        lats, lons, pads = [], [], []
+        for _, lats0, lons0, radii, lats1, lons1 in self.layers:
+            if lats1 is None:
+                lats += [lats0]
+                lons += [lons0]
+                pads += [radii]
+            else:
+                lats += [lats0, lats1]
+                lons += [lons0, lons1]
+                pads += [np.zeros(2*len(lats0))]
+        lats, lons, pads = np.concatenate(lats), np.concatenate(lons), np.concatenate(pads)
+        if zoom is None:
+            return lons.min(), lats.min(), lons.max(), lats.max()
+
+        x = _lon_to_x(lons, zoom)
+        y = _lat_to_y(lats, zoom)
+        pads = pads/self.tile_size
+        return (
+            float(_x_to_lon((x - pads).min(), zoom)), float(_y_to_lat((y + pads).max(), zoom)),
+            float(_x_to_lon((x + pads).max(), zoom)), float(_y_to_lat((y - pads).min(), zoom))
+        )
+
+    def render(self, zoom=None, center=None):
+        if not self.layers:
+            raise RuntimeError('cannot render empty map, add segments or circles first')
+        self.zoom = self._calculate_zoom() if zoom is None else zoom
+        if center is None:
+            extent = self.determine_extent(self.zoom)
+            center = ((extent[0] + extent[2])/2, (extent[1] + extent[3])/2)
+        self.x_center = float(_lon_to_x(center[0], self.zoom))
+        self.y_center = float(_lat_to_y(center[1], self.zoom))
+
+        image = Image.new('RGB', (self.width, self.height), self.background_color)
+        with metrics.timer('render.tiles'):
+            self._draw_base_layer(image)
+        with metrics.timer('render.features'):
+            self._draw_features(image)
+        return image
+
+    def _to_pixels(self, lats, lons):
+        '''
+        Returns the pixels of the coordinates on the canvas of twice the size
+        '''
+        x = (_lon_to_x(lons, self.zoom) - self.x_center)*self.tile_size + self.width/2
+        y = (_lat_to_y(lats, self.zoom) - self.y_center)*self.tile_size + self.height/2
+        return np.rint(x).astype(np.int64)*2, np.rint(y).astype(np.int64)*2
+
+    def _draw_features(self, image):
+        width, height = 2*self.width, 2*self.height
+        canvas = np.zeros((height, width, 4), np.uint8)
+        canvas[..., 0] = 255
+
+        for color, lats0, lons0, radii, lats1, lons1 in self.layers:
+            xs, ys = self._to_pixels(lats0, lons0)
+            if lats1 is not None:
+                # A Line is drawn 2*width wide on the canvas, so every pixel
+                # of the segments is the center of a disk of radius width
+                x1, y1 = self._to_pixels(lats1, lons1)
+                xs, ys = _line_centers(xs, ys, x1, y1, width, height)
+                radii = np.full(len(xs), radii[0])
+
+            spans = np.zeros((height, width + 1), np.int32)
+            _fill_disks(spans, xs, ys, radii)
+            inside = np.cumsum(spans, axis=1)[:, :width] > 0
+            canvas[inside] = ImageColor.getrgb(color)[:3] + (255,)
+
+        features = Image.fromarray(canvas, 'RGBA')
+        features = features.resize((self.width, self.height), Image.LANCZOS)
+        image.paste(features, (0, 0), features)
+
+
+def to_png(mapa):
+    '''
+    Renders mapa and returns the PNG as a file-like object
+    '''
+    image = mapa.render()
+    bio = BytesIO()
+    bio.name = 'map.png'
+    with metrics.timer('render.png'):
+        image.save(bio, 'PNG')
+    bio.seek(0)
+    return bio
+
+
+class ImageCache:
+    '''
+    In-memory LRU cache of rendered PNGs, bounded by their total size
+    '''
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.images = OrderedDict()
+        self.total = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        '''
+        Returns the cached PNG for key as a file-like object, or None
+        '''
+        with self.lock:
+            content = self.images.get(key)
+            if content is None:
+                return None
+            self.images.move_to_end(key)
+
+        bio = BytesIO(content)
+        bio.name = 'map.png'
+        return bio
+
+    def put(self, key, bio):
+        '''
+        Stores the PNG in the file-like object bio under key
+        '''
+        content = bio.getvalue()
+        with self.lock:
+            self.total += len(content) - len(self.images.pop(key, b''))
+            self.images[key] = content
+            while self.total > self.max_bytes and self.images:
+                _, old = self.images.popitem(last=False)
+                self.total -= len(old)
+
+    def get_or_render(self, key, render):
+        '''
+        Returns the cached PNG for key, calling render to produce it if it
+        is not cached. Results of None are not cached
+        '''
+        bio = self.get(key)
+        if bio is None:
+            bio = render()
+            if bio is not None:
+                self.put(key, bio)
+        return bio
+
+
+images = ImageCache(c.IMAGE_CACHE_BYTES)
+
+
+def round_coords(lat, lon):
+    '''
+    Rounds coordinates to the precision of the image cache keys
+    '''
+    return round(lat, c.IMAGE_CACHE_DECIMALS), round(lon, c.IMAGE_CACHE_DECIMALS)
+
+
+def _lon_to_x(lon, zoom):
+    '''
+    Returns the fractional tile number x of the longitude (or array of
+    longitudes) at zoom
+    '''
+    return (np.asarray(lon) + 180)/360*2**zoom
+
+
+def _lat_to_y(lat, zoom):
+    '''
+    Returns the fractional tile number y of the latitude (or array of
+    latitudes) at zoom
+    '''
+    rad = np.radians(np.clip(lat, -85.0511, 85.0511))
+    return (1 - np.log(np.tan(rad) + 1/np.cos(rad))/np.pi)/2*2**zoom
+
+
+def _x_to_lon(x, zoom):
+    '''
+    Inverse of _lon_to_x
+    '''
+    return np.asarray(x)/2**zoom*360 - 180
+
+
+def _y_to_lat(y, zoom):
+    '''
+    Inverse of _lat_to_y
+    '''
+    return np.degrees(np.arctan(np.sinh(np.pi*(1 - 2*np.asarray(y)/2**zoom))))
+
+
+def simplify_segments(lats0, lons0, lats1, lons1):
+    '''
+    Level of detail for lines: snaps the endpoints of the segments to the
+    pixel grid of the map that will show them and drops the segments that
+    become equal. The grid starts at LOD_PIXELS pixels and is made coarser
+    until at most LOD_MAX_SEGMENTS segments remain. Returns the arrays
+    (lats0, lons0, lats1, lons1) of the remaining segments, with their
+    ends at cell centers
+    '''
+    lats = np.concatenate((lats0, lats1))
+    lons = np.concatenate((lons0, lons1))
+    zoom = zoom_for_bbox(lats.min(), lons.min(), lats.max(), lons.max())
+    x0, y0 = _lon_to_x(lons0, zoom), _lat_to_y(lats0, zoom)
+    x1, y1 = _lon_to_x(lons1, zoom), _lat_to_y(lats1, zoom)
+
+    pixels = c.LOD_PIXELS
+    while True:
+        scale = c.TILE_SIZE/pixels
+        snapped = np.floor(np.column_stack((x0, y0, x1, y1))*scale).astype(np.int64)
+
+        # Segments are undirected, so put the lowest end first
+        swap = (snapped[:, 0] > snapped[:, 2]) | \
+            ((snapped[:, 0] == snapped[:, 2]) & (snapped[:, 1] > snapped[:, 3]))
+        snapped[swap] = snapped[swap][:, [2, 3, 0, 1]]
+        snapped = np.unique(snapped, axis=0)
+        if len(snapped) <= c.LOD_MAX_SEGMENTS or pixels >= c.MAP_SIZE:
+            break
+        pixels *= 2
+
+    sx0, sy0, sx1, sy1 = snapped.T
+
+    return (
+        _y_to_lat((sy0 + 0.5)/scale, zoom), _x_to_lon((sx0 + 0.5)/scale, zoom),
+        _y_to_lat((sy1 + 0.5)/scale, zoom), _x_to_lon((sx1 + 0.5)/scale, zoom)
+    )
+
+
+def merge_circles(lats, lons, pops):
+    '''
+    Level of detail for circles: merges the cities that fall in the same
+    cell of LOD_CIRCLE_PIXELS pixels of the map that will show them into
+    one city at their population-weighted center. Returns the arrays
+    (lats, lons, pops) of the merged cities
+    '''
+    zoom = zoom_for_bbox(lats.min(), lons.min(), lats.max(), lons.max())
+    scale = c.TILE_SIZE/c.LOD_CIRCLE_PIXELS
+
+    x = _lon_to_x(lons, zoom)
+    y = _lat_to_y(lats, zoom)
+    cells = np.column_stack((np.floor(x*scale), np.floor(y*scale)))
+    _, group = np.unique(cells, axis=0, return_inverse=True)
+    group = group.reshape(-1)
+
+    total = np.bincount(group, weights=pops)
+    weight = np.where(total > 0, total, 1)
+    x = np.bincount(group, weights=x*pops)/weight
+    y = np.bincount(group, weights=y*pops)/weight
+    return _y_to_lat(y, zoom), _x_to_lon(x, zoom), total
+
+
+def _tile_range(lat_min, lon_min, lat_max, lon_max, zoom):
+    '''
+    Returns the ranges of tile numbers x and y covering the bounding box
+    '''
+    last = 2**zoom - 1
+    return (
+        range(max(int(_lon_to_x(lon_min, zoom)), 0), min(int(_lon_to_x(lon_max, zoom)), last) + 1),
+        range(max(int(_lat_to_y(lat_max, zoom)), 0), min(int(_lat_to_y(lat_min, zoom)), last) + 1)
+    )
+
+
+def prefill(lat_min, lon_min, lat_max, lon_max, zooms):
+    '''
+    Downloads to the cache all the tiles of the bounding box for each of
+    the zoom levels, and returns the number of tiles fetched
+    '''
+    if offline():
+        return 0
+
+    cache = get_tile_cache()
+    fetched = 0
+    for zoom in zooms:
+        xs, ys = _tile_range(lat_min, lon_min, lat_max, lon_max, zoom)
+        for x in xs:
+            for y in ys:
+                if os.path.exists(cache.tile_path(zoom, x, y)):
+                    continue
+                url = c.TILE_URL.format(z=zoom, x=x, y=y)
+                status, _ = cache.get(url, headers={'User-Agent': 'StaticMap'})
+                fetched += status == 200
+    return fetched
+
+
+def zoom_for_bbox(lat_min, lon_min, lat_max, lon_max, size=c.MAP_SIZE):
+    '''
+    Returns the largest zoom level at which the bounding box fits in a map
+    of size pixels, as StaticMap chooses it
+    '''
+    for zoom in range(17, -1, -1):
+        width = (_lon_to_x(lon_max, zoom) - _lon_to_x(lon_min, zoom))*c.TILE_SIZE
+        height = (_lat_to_y(lat_min, zoom) - _lat_to_y(lat_max, zoom))*c.TILE_SIZE
+        if width <= size and height <= size:
+            return zoom
+    return 0
+
+
+async def fetch_tiles_async(session, lat_min, lon_min, lat_max, lon_max, zooms):
+    '''
+    Downloads concurrently with the aiohttp session the missing tiles of
+    the bounding box for each of the zoom levels
+    '''
+    if offline():
+        return
+
+    cache = get_tile_cache()
+
+    async def fetch(zoom, x, y):
+        url = c.TILE_URL.format(z=zoom, x=x, y=y)
+        try:
+            async with session.get(url, headers={'User-Agent': 'StaticMap'}) as res:
+                if res.status == 200:
+                    cache.write(cache.tile_path(zoom, x, y), await res.read())
+        except aiohttp.ClientError:
+            # The renderer will try again synchronously
+            pass
+
+    fetches = []
+    for zoom in zooms:
+        xs, ys = _tile_range(lat_min, lon_min, lat_max, lon_max, zoom)
+        fetches += [
+            fetch(zoom, x, y) for x in xs for y in ys
+            if not os.path.exists(cache.tile_path(zoom, x, y))
+        ]
+    await asyncio.gather(*fetches)
+
+
+def main():
+    '''
+    Command line tool to prefill the tile cache for a region
+    '''
+    parser = argparse.ArgumentParser(description='Prefill the map tile cache')
+    parser.add_argument('lat_min', type=float)
+    parser.add_argument('lon_min', type=float)
+    parser.add_argument('lat_max', type=float)
+    parser.add_argument('lon_max', type=float)
+    parser.add_argument('--zoom', type=int, nargs=2, default=(0, 8), metavar=('MIN', 'MAX'))
+    args = parser.parse_args()
+
+    fetched = prefill(
+        args.lat_min, args.lon_min, args.lat_max, args.lon_max,
+        range(args.zoom[0], args.zoom[1] + 1)
+    )
+    print('Fetched {} tiles into {}'.format(fetched, tile_dir()))
+
+
+if __name__ == '__main__':
+    main()
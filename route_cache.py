@@ -0,0 +1,138 @@
+'''
+Cache of the computed routes, with their lengths and rendered maps
+'''
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import constants as c
+import disk_cache
+
+
+class RouteCache:
+    '''
+    LRU cache of routes keyed by the version of their graph and the ids
+    of their two cities, bounded by its total size. Every build of a graph
+    gets a new version, so routes of older graphs are never returned and
+    age out. Routes are undirected: (src, dst) and (dst, src) share an
+    entry. With a directory, routes are also saved there (bounded by
+    disk_bytes, for all the processes sharing it) and survive restarts
+    '''
+
+    def __init__(self, max_bytes, path=None, disk_bytes=0):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # (length, path, png or None) of each route, in LRU order
+        self.routes = OrderedDict()
+        self.total = 0
+
+        self.path = path
+        # Saved routes, bounded across all the processes that share path
+        self.disk = disk_cache.DiskCache(path, disk_bytes, '.npz') if path else None
+
+    def route_path(self, key):
+        '''
+        Returns the path of the file of the route key
+        '''
+        version, src, dst = key
+        return os.path.join(self.path, version, '{}_{}.npz'.format(src, dst))
+
+    def get(self, version, src, dst):
+        '''
+        Returns the (length, list of city ids, PNG bytes or None) of the
+        cached route from src to dst in the graph version, or None
+        '''
+        key = (version, min(src, dst), max(src, dst))
+        with self.lock:
+            route = self.routes.get(key)
+            if route is not None:
+                self.routes.move_to_end(key)
+        if route is None and self.path:
+            route = self.read(key)
+            if route is not None:
+                self.remember(key, route)
+        if route is None:
+            return None
+
+        length, path, image = route
+        path = path.tolist()
+        return length, path if path[0] == src else path[::-1], image
+
+    def put(self, version, src, dst, length, path, image=None):
+        '''
+        Stores the route from src to dst in the graph version, with its
+        length, list of city ids and, if rendered, PNG bytes
+        '''
+        key = (version, min(src, dst), max(src, dst))
+        path = np.array(path if src <= dst else path[::-1], dtype=np.int32)
+        route = (float(length), path, image)
+        self.remember(key, route)
+        if self.path:
+            self.write(key, route)
+
+    def remember(self, key, route):
+        '''
+        Keeps route in memory, evicting the least recently used ones
+        '''
+        size = route[1].nbytes + len(route[2] or b'')
+        with self.lock:
+            old = self.routes.pop(key, None)
+            if old is not None:
+                self.total -= old[1].nbytes + len(old[2] or b'')
+            self.routes[key] = route
+            self.total += size
+            while self.total > self.max_bytes and self.routes:
+                _, (_, old_path, old_image) = self.routes.popitem(last=False)
+                self.total -= old_path.nbytes + len(old_image or b'')
+
+    def read(self, key):
+        '''
+        Returns the saved route key, or None if it is missing
+        '''
+        route_path = self.route_path(key)
+        try:
+            with np.load(route_path) as arrays:
+                image = arrays['image'].tobytes()
+                route = (float(arrays['length']), arrays['path'], image or None)
+        except (OSError, ValueError, KeyError):
+            return None
+        self.disk.touch(route_path)
+        return route
+
+    def write(self, key, route):
+        '''
+        Saves route, evicting the least recently used ones if needed
+        '''
+        length, path, image = route
+        route_path = self.route_path(key)
+        os.makedirs(os.path.dirname(route_path), exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(route_path, threading.get_ident())
+        with open(tmp_path, 'wb') as route_file:
+            np.savez(
+                route_file, length=length, path=path,
+                image=np.frombuffer(image or b'', dtype=np.uint8)
+            )
+        os.replace(tmp_path, route_path)
+
+        self.disk.add(route_path, os.path.getsize(route_path))
+
+
+_routes = None
+_routes_lock = threading.Lock()
+
+
+def get_route_cache():
+    '''
+    Returns the route cache of this process, saved to the directory in
+    ROUTE_DIR_ENV if set
+    '''
+    global _routes
+    with _routes_lock:
+        if _routes is None:
+            _routes = RouteCache(
+                c.ROUTE_CACHE_BYTES, os.environ.get(c.ROUTE_DIR_ENV),
+                c.ROUTE_CACHE_DISK_BYTES
+            )
+        return _routes
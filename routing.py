@@ -0,0 +1,199 @@
+'''
+Shortest paths over the CSR adjacency of a graph
+'''
+import heapq
+import math
+
+import numpy as np
+
+import constants as c
+import graph_utilities as gu
+
+
+def dijkstra(indptr, indices, weights, source):
+    '''
+    Returns the array of distances from source to every node, with inf
+    for the unreachable ones
+    '''
+    dist = np.full(len(indptr) - 1, np.inf)
+    dist[source] = 0
+    heap = [(0.0, source)]
+    while heap:
+        d, u = heapq.heappop(heap)
+        if d > dist[u]:
+            continue
+        first, last = indptr[u], indptr[u + 1]
+        for v, w in zip(indices[first:last].tolist(), weights[first:last].tolist()):
+            if d + w < dist[v]:
+                dist[v] = d + w
+                heapq.heappush(heap, (d + w, v))
+    return dist
+
+
+class Landmarks:
+    '''
+    Distances from a few landmark nodes to all the others, which give the
+    ALT lower bound |d(L, t) - d(L, v)| of the distance from v to t
+    '''
+
+    def __init__(self, indptr, indices, weights, k):
+        n = len(indptr) - 1
+        self.dists = np.zeros((0, n))
+        if n == 0:
+            return
+
+        # Farthest selection: each landmark is the node farthest from the
+        # previous ones, starting from the node with most neighbours
+        rows = []
+        closest = np.full(n, np.inf)
+        landmark = int(np.argmax(np.diff(indptr)))
+        for _ in range(k):
+            dist = dijkstra(indptr, indices, weights, landmark)
+            rows.append(dist)
+            closest = np.minimum(closest, dist)
+            reachable = np.where(np.isfinite(closest), closest, -1)
+            landmark = int(np.argmax(reachable))
+            if reachable[landmark] <= 0:
+                break
+        self.dists = np.array(rows)
+
+    def bound(self, nodes, t):
+        '''
+        Returns the ALT lower bounds of the distances from each of nodes to t
+        '''
+        if len(self.dists) == 0:
+            return np.zeros(len(nodes))
+        dv, dt = self.dists[:, nodes], self.dists[:, [t]]
+        known = np.isfinite(dv) & np.isfinite(dt)
+        with np.errstate(invalid='ignore'):
+            return np.where(known, np.abs(dt - dv), 0).max(axis=0)
+
+
+def astar(indptr, indices, weights, lats, lons, source, target, landmarks=None):
+    '''
+    Returns the list of nodes of the shortest path from source to target,
+    or None if there is none. The great-circle distance to target (and
+    the landmark bound, if given) guides the search; both are lower bounds
+    because every edge weighs its own great-circle distance
+    '''
+    target_lat, target_lon = lats[target], lons[target]
+
+    def heuristic(nodes):
+        h = gu.haversine_array(lats[nodes], lons[nodes], target_lat, target_lon)
+        if landmarks is not None:
+            h = np.maximum(h, landmarks.bound(nodes, target))
+        # Weights are stored as float32, leave room for their rounding
+        return (h*(1 - c.HEURISTIC_SLACK)).tolist()
+
+    dist = {source: 0.0}
+    parent = {source: None}
+    closed = set()
+    heap = [(heuristic([source])[0], source)]
+    while heap:
+        _, u = heapq.heappop(heap)
+        if u == target:
+            path = []
+            while u is not None:
+                path.append(u)
+                u = parent[u]
+            return path[::-1]
+        if u in closed:
+            continue
+        closed.add(u)
+
+        # The heuristic is evaluated at once for all the neighbours of u
+        d = dist[u]
+        first, last = indptr[u], indptr[u + 1]
+        neighbours = indices[first:last]
+        for v, w, h in zip(neighbours.tolist(), weights[first:last].tolist(), heuristic(neighbours)):
+            if v not in closed and d + w < dist.get(v, math.inf):
+                dist[v] = d + w
+                parent[v] = u
+                heapq.heappush(heap, (d + w + h, v))
+    return None
+
+
+def dijkstra_paths(indptr, indices, weights, source, targets):
+    '''
+    Returns a dict with the (length, list of nodes) of the shortest path
+    from source to each of targets that is reachable. A single search
+    serves all of them, and it stops once the farthest one is settled
+    '''
+    pending = set(targets)
+    dist = {source: 0.0}
+    parent = {source: None}
+    closed = set()
+    found = dict()
+    heap = [(0.0, source)]
+    while heap and pending:
+        d, u = heapq.heappop(heap)
+        if u in closed:
+            continue
+        closed.add(u)
+        if u in pending:
+            pending.discard(u)
+            path = []
+            v = u
+            while v is not None:
+                path.append(v)
+                v = parent[v]
+            found[u] = (d, path[::-1])
+
+        first, last = indptr[u], indptr[u + 1]
+        for v, w in zip(indices[first:last].tolist(), weights[first:last].tolist()):
+            if v not in closed and d + w < dist.get(v, math.inf):
+                dist[v] = d + w
+                parent[v] = u
+                heapq.heappush(heap, (d + w, v))
+    return found
+
+
+def path_length(indptr, indices, weights, path):
+    '''
+    Returns the sum of the weights of the edges of path
+    '''
+    length = 0.0
+    for u, v in zip(path[:-1], path[1:]):
+        first, last = indptr[u], indptr[u + 1]
+        neighbours = indices[first:last]
+        length += float(weights[first + np.flatnonzero(neighbours == v)[0]])
+    return length
+
+
+def astar_lazy(neighbours, lats, lons, source, target):
+    '''
+    Returns the (length, list of nodes) of the shortest path from source
+    to target, or None if there is none. It is astar over a graph whose
+    adjacency is only read as the search reaches it: neighbours(u)
+    returns the arrays (nodes, weights) of the neighbours of u
+    '''
+    target_lat, target_lon = lats[target], lons[target]
+
+    def heuristic(nodes):
+        h = gu.haversine_array(lats[nodes], lons[nodes], target_lat, target_lon)
+        return (h*(1 - c.HEURISTIC_SLACK)).tolist()
+
+    dist = {source: 0.0}
+    parent = {source: None}
+    closed = set()
+    heap = [(heuristic([source])[0], source)]
+    while heap:
+        _, u = heapq.heappop(heap)
+        if u == target:
+            path = []
+            while u is not None:
+                path.append(u)
+                u = parent[u]
+            return dist[target], path[::-1]
+        if u in closed:
+            continue
+        closed.add(u)
+
+        d = dist[u]
+        nodes, node_weights = neighbours(u)
+        for v, w, h in zip(nodes.tolist(), node_weights.tolist(), heuristic(nodes)):
+            if v not in closed and d + w < dist.get(v, math.inf):
+                dist[v] = d + w
+                parent[v] = u
+                heapq.heappush(heap, (d + w + h, v))
+    return None
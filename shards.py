@@ -0,0 +1,485 @@
+'''
+Sharded graphs: the cities are split in cells of a latitude/longitude
+grid, each cell is a graph stored on its own and the edges between cells
+are kept in a boundary table. Shards are opened only when a query reaches
+them, so memory grows with the regions queried rather than with the graph
+'''
+import argparse
+import json
+import logging
+import math
+import os
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+
+import constants as c
+import dataset
+import graph
+import graph_utilities as gu
+import metrics
+import routing
+
+
+def shard_path(max_dist, min_pop):
+    '''
+    Returns the path of the sharded snapshot of the graph (max_dist, min_pop)
+    '''
+    return os.path.join(c.SHARD_DIR, '{}_{}'.format(max_dist, min_pop))
+
+
+def grid(max_dist):
+    '''
+    Returns the number of rows and columns of the grid for max_dist. Cells
+    span at least max(max_dist, SHARD_CELL_SIZE) km of latitude, so edges
+    only join cities of contiguous rows
+    '''
+    side = math.degrees(max(max_dist, c.SHARD_CELL_SIZE)/c.EARTH_RADIUS)
+    return max(int(180//side), 1), max(int(360//side), 1)
+
+
+def cells_of(lats, lons, rows, cols):
+    '''
+    Returns the cell (row*cols + col) of each city
+    '''
+    row = np.clip(((np.asarray(lats) + 90)*rows/180).astype(np.int64), 0, rows - 1)
+    col = np.clip(((np.asarray(lons) + 180)*cols/360).astype(np.int64), 0, cols - 1)
+    return row*cols + col
+
+
+def _columns(lon_min, lon_max, cols):
+    '''
+    Returns the columns of the grid that meet the longitudes [lon_min,
+    lon_max], which may go beyond [-180, 180]
+    '''
+    if lon_max - lon_min >= 360:
+        return list(range(cols))
+    first = math.floor((lon_min + 180)*cols/360)
+    last = math.floor((lon_max + 180)*cols/360)
+    return sorted({col % cols for col in range(first, last + 1)})
+
+
+def _reach(lat_min, lat_max, dist):
+    '''
+    Returns the largest difference of longitude, in degrees, of two cities
+    at distance up to dist with latitudes in [lat_min, lat_max], or 360 if
+    they can be at any longitude
+    '''
+    top = max(abs(lat_min), abs(lat_max))
+    if top >= 90:
+        return 360
+    # Two cities at latitude top and distance dist differ at most in this
+    # longitude; at any other latitude in the range, they differ less
+    ratio = math.sin(dist/(2*c.EARTH_RADIUS))/math.cos(math.radians(top))
+    if ratio >= 1:
+        return 360
+    return math.degrees(2*math.asin(ratio))
+
+
+def neighbour_cells(cell, rows, cols, dist):
+    '''
+    Returns the cells that may have cities at distance up to dist from the
+    cities of cell
+    '''
+    row, col = divmod(cell, cols)
+    first, last = max(row - 1, 0), min(row + 1, rows - 1)
+    lat_min, lat_max = -90 + first*180/rows, -90 + (last + 1)*180/rows
+    lon_min, lon_max = -180 + col*360/cols, -180 + (col + 1)*360/cols
+    reach = _reach(lat_min, lat_max, dist)
+    columns = _columns(lon_min - reach, lon_max + reach, cols)
+    return [r*cols + column for r in range(first, last + 1) for column in columns]
+
+
+@metrics.timer('shards.build')
+def build(max_dist, min_pop, path, cities=None, workers=1):
+    '''
+    Builds the sharded graph (max_dist, min_pop) from the cities DataFrame
+    (by default the dataset) and writes it to the directory path, replacing
+    it atomically if it already exists (see graph.Graph.save). Only one
+    shard is in memory at once
+    '''
+    if cities is None:
+        cities = dataset.load_cities(min_pop)
+    rows, cols = grid(max_dist)
+
+    # Global city ids are contiguous in each shard: cities sorted by cell
+    dataframe, keys = graph.select_cities(cities, min_pop)
+    lats = dataframe['Latitude'].to_numpy(dtype=float)
+    lons = dataframe['Longitude'].to_numpy(dtype=float)
+    order = np.argsort(cells_of(lats, lons, rows, cols), kind='stable')
+    dataframe, keys = dataframe.iloc[order], keys[order]
+    lats, lons = lats[order], lons[order]
+    cells, starts = np.unique(cells_of(lats, lons, rows, cols), return_index=True)
+    offsets = np.append(starts, len(lats)).astype(np.int64)
+
+    tmp_path = '{}.{}.tmp'.format(path.rstrip('/'), uuid.uuid4().hex)
+    os.makedirs(os.path.join(tmp_path, 'shards'))
+
+    # Shards, with their components numbered after the previous ones
+    components = np.zeros(len(lats), dtype=np.int64)
+    n_labels = 0
+    edges = 0
+    for k, cell in enumerate(cells.tolist()):
+        first, last = offsets[k], offsets[k + 1]
+        shard = graph.Graph(max_dist, min_pop, dataframe.iloc[first:last], workers)
+        shard.save(os.path.join(tmp_path, 'shards', str(cell)))
+        components[first:last] = shard.components + n_labels
+        n_labels += shard.n_components
+        edges += shard.get_number_edges()
+
+    # Edges between each cell and the following ones
+    shard_of = {cell: k for k, cell in enumerate(cells.tolist())}
+    boundary = []
+    for k, cell in enumerate(cells.tolist()):
+        others = [
+            shard_of[other] for other in neighbour_cells(cell, rows, cols, max_dist)
+            if other > cell and other in shard_of
+        ]
+        if not others:
+            continue
+        ids = np.concatenate([np.arange(offsets[k], offsets[k + 1])] + [
+            np.arange(offsets[other], offsets[other + 1]) for other in others
+        ])
+        src, dst, weights = gu.build_edges(lats[ids], lons[ids], max_dist)
+        # src < dst, so the crossing edges start in this cell
+        crossing = (src < offsets[k + 1] - offsets[k]) & (dst >= offsets[k + 1] - offsets[k])
+        boundary.append((ids[src[crossing]], ids[dst[crossing]], weights[crossing]))
+
+    if boundary:
+        src, dst, weights = (np.concatenate(arrays) for arrays in zip(*boundary))
+    else:
+        src, dst, weights = np.zeros(0), np.zeros(0), np.zeros(0)
+    edges += len(src)
+
+    # Components of the whole graph: the ones of the shards joined by the
+    # boundary edges
+    src, dst = src.astype(np.int64), dst.astype(np.int64)
+    joined = gu.connected_components(n_labels, components[src], components[dst])
+    components = joined[components].astype(np.int32)
+
+    # Boundary edges in both directions, sorted by their first city
+    both_src = np.concatenate((src, dst))
+    order = np.argsort(both_src, kind='stable')
+    countries = dataframe['Country'].astype(str).str.lower().to_numpy()
+    by_country = np.argsort(countries, kind='stable')
+    codes, country_starts = np.unique(countries[by_country], return_index=True)
+    country_ends = np.append(country_starts[1:], len(countries))
+
+    names = gu.NameTable.from_strings(keys)
+    arrays = {
+        'names': names.data,
+        'name_offsets': names.offsets,
+        'lats': lats,
+        'lons': lons,
+        'pops': dataframe['Population'].to_numpy(dtype=float),
+        'components': components,
+        'cells': cells,
+        'offsets': offsets,
+        'boundary_src': both_src[order].astype(np.int32),
+        'boundary_dst': np.concatenate((dst, src))[order].astype(np.int32),
+        'boundary_weights': np.concatenate((weights, weights))[order].astype(np.float32),
+        'by_country': by_country.astype(np.int32)
+    }
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_path, name + '.npy'), array)
+
+    meta = {
+        'format': c.SHARD_FORMAT,
+        'max_dist': max_dist,
+        'min_pop': min_pop,
+        'rows': rows,
+        'cols': cols,
+        'edges': int(edges),
+        'n_components': int(components.max()) + 1 if len(components) else 0,
+        'countries': {
+            code: [int(start), int(end)]
+            for code, start, end in zip(codes.tolist(), country_starts, country_ends)
+        },
+        'version': uuid.uuid4().hex,
+        'dataset': dataset.version()
+    }
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as meta_file:
+        json.dump(meta, meta_file)
+
+    if os.path.exists(path):
+        shutil.rmtree(path, ignore_errors=True)
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        # Another process saved it after the rmtree; theirs is as good
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+class ShardedGraph(graph.GraphQueries):
+    '''
+    Graph whose shards are opened on demand and kept in an LRU bounded by
+    SHARD_CACHE_ELEMENTS nodes plus edges. Counts, plots and routes work
+    as in Graph, which also has the whole-graph operations (G, derive,
+    save) that a sharded graph does not
+    '''
+
+    sharded = True
+
+    def __init__(self, path):
+        '''
+        Opens the sharded snapshot directory path written by build. The
+        arrays of the whole graph are memory-mapped
+        '''
+        with open(os.path.join(path, 'meta.json')) as meta_file:
+            meta = json.load(meta_file)
+        if meta.get('format') != c.SHARD_FORMAT:
+            raise ValueError('Unsupported sharded snapshot format in ' + path)
+
+        def array(name):
+            return np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+
+        self.path = path
+        self.max_dist = meta['max_dist']
+        self.min_pop = meta['min_pop']
+        self.version = meta['version']
+        self.rows, self.cols = meta['rows'], meta['cols']
+        self.n_edges = meta['edges']
+        self.n_components = meta['n_components']
+        self.countries = meta['countries']
+        self.names = gu.NameTable(array('names'), array('name_offsets'))
+        self.lats = array('lats')
+        self.lons = array('lons')
+        self.pops = array('pops')
+        self.components = array('components')
+        self.cells = np.asarray(array('cells'))
+        self.offsets = np.asarray(array('offsets'))
+        self.boundary_src = array('boundary_src')
+        self.boundary_dst = array('boundary_dst')
+        self.boundary_weights = array('boundary_weights')
+        self.by_country = array('by_country')
+
+        self.lock = threading.Lock()
+        self.shards = OrderedDict()
+        self.loaded_elements = 0
+        self.name_indexes = OrderedDict()
+
+    def get_number_edges(self):
+        '''
+        Returns the number of edges in the graph
+        '''
+        return self.n_edges
+
+    def shard(self, k):
+        '''
+        Returns the graph of the k-th shard, opening it if needed
+        '''
+        with self.lock:
+            if k in self.shards:
+                self.shards.move_to_end(k)
+                return self.shards[k]
+
+        shard = graph.Graph.load(os.path.join(self.path, 'shards', str(self.cells[k])))
+        size = shard.get_number_nodes() + shard.get_number_edges()
+        with self.lock:
+            if k not in self.shards:
+                self.shards[k] = shard
+                self.loaded_elements += size
+            while self.loaded_elements > c.SHARD_CACHE_ELEMENTS and len(self.shards) > 1:
+                _, old = self.shards.popitem(last=False)
+                self.loaded_elements -= old.get_number_nodes() + old.get_number_edges()
+            return self.shards[k]
+
+    def shards_of(self, ids):
+        '''
+        Returns the shard of each of the city ids
+        '''
+        return np.searchsorted(self.offsets, ids, 'right') - 1
+
+    def shards_around(self, lat, lon, dist):
+        '''
+        Returns the shards that may have cities at distance lower or equal
+        than dist from (lat, lon)
+        '''
+        if len(self.cells) == 0:
+            return []
+
+        dlat = math.degrees(dist/c.EARTH_RADIUS)
+        lat_min, lat_max = max(lat - dlat, -90), min(lat + dlat, 90)
+        first = min(int((lat_min + 90)*self.rows/180), self.rows - 1)
+        last = min(int((lat_max + 90)*self.rows/180), self.rows - 1)
+        if lat_min <= -90 or lat_max >= 90:
+            columns = list(range(self.cols))
+        else:
+            ratio = math.sin(dist/c.EARTH_RADIUS)/math.cos(math.radians(lat))
+            dlon = 360 if ratio >= 1 else math.degrees(math.asin(ratio))
+            columns = _columns(lon - dlon, lon + dlon, self.cols)
+
+        wanted = np.array([
+            row*self.cols + column for row in range(first, last + 1) for column in columns
+        ])
+        pos = np.minimum(np.searchsorted(self.cells, wanted), len(self.cells) - 1)
+        return pos[self.cells[pos] == wanted].tolist()
+
+    def cities_within(self, lat, lon, dist):
+        '''
+        Returns the ids of the cities at distance lower or equal than dist
+        from (lat, lon)
+        '''
+        ids = [
+            self.shard(k).cities_within(lat, lon, dist) + self.offsets[k]
+            for k in self.shards_around(lat, lon, dist)
+        ]
+        return np.concatenate(ids) if ids else np.zeros(0, dtype=np.int64)
+
+    def edges_between(self, ids):
+        '''
+        Returns the arrays (src, dst) of the edges with both ends in the
+        sorted array of city ids
+        '''
+        ids = np.asarray(ids, dtype=np.int64)
+        src, dst = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+        if len(ids) == 0:
+            return src[0], dst[0]
+
+        shards = self.shards_of(ids)
+        for k in np.unique(shards).tolist():
+            local = ids[shards == k] - self.offsets[k]
+            shard_src, shard_dst = self.shard(k).edges_between(local)
+            src.append(shard_src + self.offsets[k])
+            dst.append(shard_dst + self.offsets[k])
+
+        # Boundary edges leaving ids, kept if they also end in ids. Keys of
+        # the same type as the table, or searchsorted copies all of it
+        keys = ids.astype(self.boundary_src.dtype)
+        first = np.searchsorted(self.boundary_src, keys, 'left')
+        counts = np.searchsorted(self.boundary_src, keys, 'right') - first
+        rows = np.repeat(first, counts) + np.arange(counts.sum()) - \
+            np.repeat(np.cumsum(counts) - counts, counts)
+        boundary_src = np.repeat(ids, counts)
+        boundary_dst = np.asarray(self.boundary_dst[rows], dtype=np.int64)
+        pos = np.minimum(np.searchsorted(ids, boundary_dst), len(ids) - 1)
+        inside = (ids[pos] == boundary_dst) & (boundary_src < boundary_dst)
+        src.append(boundary_src[inside])
+        dst.append(boundary_dst[inside])
+        return np.concatenate(src), np.concatenate(dst)
+
+    def neighbours(self, city):
+        '''
+        Returns the arrays (ids, weights) of the neighbours of the city
+        '''
+        k = int(self.shards_of(city))
+        shard, offset = self.shard(k), self.offsets[k]
+        local = city - offset
+        first, last = shard.indptr[local], shard.indptr[local + 1]
+        key = self.boundary_src.dtype.type(city)
+        boundary_first = np.searchsorted(self.boundary_src, key, 'left')
+        boundary_last = np.searchsorted(self.boundary_src, key, 'right')
+        return (
+            np.concatenate((
+                shard.indices[first:last] + offset,
+                self.boundary_dst[boundary_first:boundary_last]
+            )),
+            np.concatenate((
+                shard.weights[first:last],
+                self.boundary_weights[boundary_first:boundary_last]
+            ))
+        )
+
+    def get_city_id(self, name):
+        '''
+        Returns the id of the most similar city to name, which must be
+        "city, country" with a known country: only the cities of that
+        country are searched, and their index is kept for the next queries.
+        Returns None for other names, as indexing all the cities would
+        take memory in proportion to the whole graph
+        '''
+        from city_index import CityIndex, normalize
+
+        _, comma, country = normalize(name).rpartition(',')
+        country = country.strip()
+        if not comma or country not in self.countries:
+            return None
+
+        with self.lock:
+            index = self.name_indexes.get(country)
+            if index is not None:
+                self.name_indexes.move_to_end(country)
+        first, last = self.countries[country]
+        ids = self.by_country[first:last]
+        if index is None:
+            index = CityIndex([self.names[city] for city in ids.tolist()])
+            with self.lock:
+                self.name_indexes[country] = index
+                while len(self.name_indexes) > c.SHARD_NAME_INDEXES:
+                    self.name_indexes.popitem(last=False)
+
+        city = index.lookup(name)
+        if city is not None:
+            return int(ids[city])
+
+    def shortest_path(self, src, dst):
+        '''
+        Returns the list of city ids of the shortest route between the
+        cities src and dst, or None if they are not connected. Only the
+        shards the search reaches are opened
+        '''
+        found = self.shortest_paths(src, [dst])[0]
+        if found is not None:
+            return found[1]
+
+    def shortest_paths(self, src, dsts):
+        '''
+        Returns, for each of the city ids dsts, the (length, list of city
+        ids) of the shortest route from the city src, or None if they are
+        not connected. Each target gets its own A* search, which opens
+        fewer shards than a search for all of them
+        '''
+        found = dict()
+        for dst in set(dsts):
+            if self.components[dst] == self.components[src]:
+                found[dst] = routing.astar_lazy(self.neighbours, self.lats, self.lons, src, dst)
+        return [found.get(dst) for dst in dsts]
+
+
+def open_current(max_dist, min_pop):
+    '''
+    Returns the sharded graph (max_dist, min_pop) if it has a snapshot up
+    to date with the dataset, otherwise None
+    '''
+    path = shard_path(max_dist, min_pop)
+    try:
+        with open(os.path.join(path, 'meta.json')) as meta_file:
+            meta = json.load(meta_file)
+        version = dataset.version()
+        if version and meta.get('dataset') == version:
+            return ShardedGraph(path)
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def main():
+    '''
+    Command line tool: builds the sharded snapshot of a graph, which the
+    bots then open instead of building the graph in memory
+    '''
+    parser = argparse.ArgumentParser(description='Build a sharded GraphBot graph')
+    parser.add_argument('max_dist', type=int)
+    parser.add_argument('min_pop', type=int)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='processes used to build each shard')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    path = shard_path(args.max_dist, args.min_pop)
+    os.makedirs(c.SHARD_DIR, exist_ok=True)
+    build(args.max_dist, args.min_pop, path, workers=args.workers)
+
+    sharded = ShardedGraph(path)
+    logging.info(
+        'Saved %s: %d cities, %d edges, %d components in %d shards',
+        path, sharded.get_number_nodes(), sharded.get_number_edges(),
+        sharded.get_number_components(), len(sharded.cells)
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+'''
+Tests of the graphs built from small DataFrames of cities
+'''
+import numpy as np
+import pandas as pd
+
+import graph
+import graph_utilities as gu
+
+
+def make_cities():
+    '''
+    Returns cities around Barcelona, with two 'Sant Joan' rows of the same
+    key whose populations are on both sides of 100000
+    '''
+    return pd.DataFrame({
+        'Country': ['es', 'es', 'es', 'es', 'es', 'es'],
+        'AccentCity': ['Sant Joan', 'Barcelona', 'Sant Joan', 'Girona', 'Reus', 'Vic'],
+        'Region': ['56', '56', '56', '56', '56', '56'],
+        'Population': [200000.0, 1500000.0, 90000.0, 95000.0, 105000.0, 120000.0],
+        'Latitude': [41.5, 41.38, 41.9, 41.98, 41.15, 41.93],
+        'Longitude': [2.3, 2.17, 2.8, 2.82, 1.1, 2.25]
+    })
+
+
+def assert_same_graph(derived, built):
+    assert derived.names.tolist() == built.names.tolist()
+    np.testing.assert_array_equal(derived.lats, built.lats)
+    np.testing.assert_array_equal(derived.pops, built.pops)
+    np.testing.assert_array_equal(derived.indptr, built.indptr)
+    np.testing.assert_array_equal(derived.indices, built.indices)
+    np.testing.assert_allclose(derived.weights, built.weights)
+    assert derived.n_components == built.n_components
+
+
+def test_duplicated_keys_keep_most_populated():
+    built = graph.Graph(300, 80000, cities=make_cities())
+    sant_joan = built.names.tolist().index('Sant Joan, es; 56')
+    assert built.get_number_nodes() == 5
+    assert built.pops[sant_joan] == 200000
+
+
+def test_derive_equals_build_with_duplicated_keys():
+    cities = make_cities()
+    base = graph.Graph(300, 80000, cities=cities)
+    for max_dist, min_pop in [(300, 80000), (300, 100000), (100, 90000), (50, 150000)]:
+        assert_same_graph(
+            base.derive(max_dist, min_pop),
+            graph.Graph(max_dist, min_pop, cities=cities)
+        )
+
+
+def test_derive_measures_edges_at_max_dist():
+    cities = make_cities()
+    base = graph.Graph(300, 80000, cities=cities)
+    src, dst, weights = base.edges()
+    exact = gu.haversine_array(base.lats[src], base.lons[src], base.lats[dst], base.lons[dst])
+    # Edges whose float32 weight rounds down are shorter than max_dist
+    # once stored, but not when built
+    for max_dist in weights[weights < exact].tolist():
+        assert_same_graph(
+            base.derive(max_dist, 80000),
+            graph.Graph(max_dist, 80000, cities=cities)
+        )
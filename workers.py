@@ -0,0 +1,186 @@
+'''
+Pool of worker processes for graph building and map rendering, so that
+the bot handlers never block on them
+'''
+import logging
+import multiprocessing
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import constants as c
+import graph
+import metrics
+
+
+# Jobs, run in the worker processes. Graphs are taken from the registry of
+# each worker, which opens the snapshots saved by the other processes
+
+def plot_job(key, command, lat, lon, dist):
+    '''
+    Returns the PNG bytes of the plot command ('plotpop' or 'plotgraph')
+    of the graph key, or None if there is nothing to plot
+    '''
+    image = getattr(graph.get_graph(*key), command)(lat, lon, dist)
+    if image is not None:
+        return image.getvalue()
+
+
+def route_job(key, src, dst):
+    '''
+    Returns the PNG bytes of the route between src and dst in the graph
+    key, or one of the failure constants
+    '''
+    image = graph.get_graph(*key).route(src, dst)
+    if image in (c.SOURCE_FAIL, c.DEST_FAIL, c.PATH_FAIL):
+        return image
+    return image.getvalue()
+
+
+def distances_job(key, src, dsts):
+    '''
+    Returns the length of the shortest route from src to each of dsts in
+    the graph key, or one of the failure constants
+    '''
+    return [
+        result if result in (c.SOURCE_FAIL, c.DEST_FAIL, c.PATH_FAIL) else result[0]
+        for result in graph.get_graph(*key).distances(src, dsts)
+    ]
+
+
+def count_job(key, command):
+    '''
+    Returns the result of the count command ('get_number_nodes',
+    'get_number_edges' or 'get_number_components') of the graph key
+    '''
+    return getattr(graph.get_graph(*key), command)()
+
+
+def build_job(max_dist, min_pop):
+    '''
+    Builds the graph (max_dist, min_pop) and saves its snapshot
+    '''
+    graph.get_graph(max_dist, min_pop)
+
+
+def measured(func, *args):
+    '''
+    Returns the result of func(*args) and the timings taken while running
+    it, so that the ones of a worker process reach the metrics of the bot
+    '''
+    with metrics.recording() as timings, metrics.profiled(func.__name__):
+        result = func(*args)
+    return result, timings
+
+
+class WorkerPool:
+    '''
+    Runs jobs in a process pool with a bounded number of queued jobs per
+    chat. Chats are served round-robin, so a chat with many heavy jobs
+    does not delay the others
+    '''
+
+    def __init__(self, workers=c.RENDER_WORKERS, max_queued=c.MAX_QUEUED_JOBS,
+                 max_per_chat=c.MAX_QUEUED_JOBS_PER_CHAT):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.max_per_chat = max_per_chat
+        self.executor = ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context('spawn')
+        )
+        # Callbacks upload photos and send messages, so they run on their
+        # own threads rather than on the one that collects the results
+        self.callbacks = ThreadPoolExecutor(c.CALLBACK_THREADS)
+        self.lock = threading.Lock()
+        # Notified when a job finishes, for shutdown
+        self.finished = threading.Condition(self.lock)
+        # Queued jobs of each chat, in round-robin order
+        self.queues = OrderedDict()
+        self.queued = 0
+        self.running = 0
+
+    def submit(self, chat_id, callback, func, *args):
+        '''
+        Queues func(*args) and returns True, or returns False if the queue
+        (or the queue of the chat) is full. When the job finishes,
+        callback(result, error) is called from a callback thread. The time jobs
+        wait in the queue and their timings are added to the metrics
+        '''
+        with self.lock:
+            queue = self.queues.setdefault(chat_id, deque())
+            if self.queued >= self.max_queued or len(queue) >= self.max_per_chat:
+                if not queue:
+                    del self.queues[chat_id]
+                return False
+            queue.append((func, args, callback, time.perf_counter()))
+            self.queued += 1
+        self._dispatch()
+        return True
+
+    def _dispatch(self):
+        '''
+        Sends queued jobs to the processes while some of them are idle.
+        Jobs wait here rather than in the executor to keep the order fair
+        '''
+        started = []
+        with self.lock:
+            while self.running < self.workers and self.queues:
+                chat_id, queue = next(iter(self.queues.items()))
+                func, args, callback, queued_at = queue.popleft()
+                del self.queues[chat_id]
+                if queue:
+                    self.queues[chat_id] = queue
+                self.queued -= 1
+                self.running += 1
+                metrics.observe('queue.wait', time.perf_counter() - queued_at)
+                started.append((self.executor.submit(measured, func, *args), callback))
+
+        # Outside the lock, as callbacks of finished futures run right away
+        for future, callback in started:
+            future.add_done_callback(
+                lambda future, callback=callback: self._done(future, callback)
+            )
+
+    def _done(self, future, callback):
+        '''
+        Dispatches the next jobs and hands the result of a finished job to
+        the callback threads
+        '''
+        with self.lock:
+            self.running -= 1
+            self.finished.notify_all()
+        self._dispatch()
+        self.callbacks.submit(self._report, future, callback)
+
+    def _report(self, future, callback):
+        '''
+        Calls callback with the result of the finished job future
+        '''
+        try:
+            error = future.exception()
+            result = None
+            if error is None:
+                result, timings = future.result()
+                metrics.merge(timings)
+            callback(result, error)
+        except Exception:
+            logging.exception('Job callback failed')
+
+    def warm_up(self, func, *args):
+        '''
+        Submits func(*args) once per worker, which starts the processes and
+        lets them load what the jobs need before the first ones arrive
+        '''
+        for _ in range(self.workers):
+            self.executor.submit(func, *args)
+
+    def shutdown(self):
+        '''
+        Waits for the queued and running jobs and their callbacks and stops
+        the processes
+        '''
+        with self.lock:
+            self.finished.wait_for(lambda: not self.queued and not self.running)
+        self.executor.shutdown()
+        self.callbacks.shutdown()